@@ -1,12 +1,39 @@
-from .rep import ResizeableDocument, Rep, IterableToBytes, IterableWithLength
+from .rep import ResizeableDocument, Rep, IterableToBytes
 import collections
 
+try:
+    import numpy
+except ImportError:
+    numpy = None # ndarray needs it, occupied compares faster with it
+
 class FixedArray(collections.abc.MutableSequence):
-    def __init__(self, itemsize, id=b'', rep=None):
-        self.doc = ResizeableDocument(id, rep)
+    # aligned arrays keep a whole number of items in every chunk but the
+    # last, so an item is found by arithmetic and written by replacing the
+    # one chunk holding it. writes that change the length recut the chunks
+    # after them. an array opened aligned over chunks cut otherwise is used
+    # unaligned, with aligned False. the id of a paged aligned array ends in
+    # its 4-byte chunk length, so opening it does not fetch every leaf page.
+    def __init__(self, itemsize, id=b'', rep=None, sized=False, paged=False, aligned=False):
+        self.doc = ResizeableDocument(id, rep, sized, paged)
         self._itemsize = itemsize
+        self.aligned = aligned and self._is_aligned(id)
+    def _chunk(self):
+        # the length of every aligned chunk but the last
+        sz = self._itemsize
+        return self.doc._allocsize // sz * sz
+    def _is_aligned(self, id):
+        sz = self._itemsize
+        chunk = self._chunk()
+        if chunk == 0:
+            return False
+        if self.doc.paged and len(id) == self.doc._idsize * 2 + 4:
+            return int.from_bytes(id[-4:], 'little') == chunk and self.doc._table.total % sz == 0
+        sizes = self.doc._table.sizes()
+        return all([size == chunk for size in sizes[:-1]]) and (not sizes or sizes[-1] <= chunk and sizes[-1] % sz == 0)
     @property
     def id(self):
+        if self.aligned and self.doc.paged:
+            return self.doc.id + self._chunk().to_bytes(4, 'little')
         return self.doc.id
     def __len__(self):
         return len(self.doc) // self._itemsize
@@ -15,11 +42,98 @@ class FixedArray(collections.abc.MutableSequence):
         if type(slice) is int:
             if slice < 0 or slice >= len(self):
                 raise IndexError('index out of range')
+            if self.aligned:
+                per = self.doc._allocsize // sz
+                off = slice % per * sz
+                return self.doc.rep.manager.fetch_range(self.doc._table.id(slice // per), off, off + sz)
             return self.doc[slice * sz : (slice + 1) * sz]
         else:
             start, stop, step = slice.indices(len(self))
             data = self.doc[start * sz : stop * sz]
             return [data[off:off+sz] for off in range(0,len(data),sz)][::step]
+    def readinto(self, buffer, start=0, stop=None):
+        # copies items start:stop directly into buffer, returning the count
+        sz = self._itemsize
+        start, stop, step = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        return self.doc.readinto(buffer, start * sz, stop * sz) // sz
+    def view(self, slice, buffer=None):
+        # like a slice read, but the items are memoryviews over one buffer
+        sz = self._itemsize
+        start, stop, step = slice.indices(len(self))
+        stop = max(start, stop)
+        if buffer is None:
+            buffer = bytearray((stop - start) * sz)
+        buffer = memoryview(buffer)
+        self.readinto(buffer, start, stop)
+        return [buffer[off:off+sz] for off in range(0, (stop - start) * sz, sz)][::step]
+    def ndarray(self, slice, dtype=None):
+        # items in slice as a numpy array over one buffer. dtype is S{itemsize}
+        # by default, or a structured dtype of itemsize to read records.
+        if numpy is None:
+            raise ImportError('FixedArray.ndarray needs numpy')
+        sz = self._itemsize
+        dtype = numpy.dtype(f'S{sz}' if dtype is None else dtype)
+        assert dtype.itemsize == sz
+        start, stop, step = slice.indices(len(self))
+        stop = max(start, stop)
+        buffer = bytearray((stop - start) * sz)
+        self.readinto(buffer, start, stop)
+        return numpy.frombuffer(buffer, dtype)[::step]
+    def take(self, indices):
+        # the items at indices, in their order. each chunk holding any of
+        # them is fetched once, all in one batch.
+        sz = self._itemsize
+        length = len(self)
+        table = self.doc._table
+        spans = [] # per index, [first chunk, offset in it, last chunk]
+        for idx in indices:
+            if idx < 0 or idx >= length:
+                raise IndexError('index out of range')
+            if self.aligned:
+                per = self.doc._allocsize // sz
+                spans.append([idx // per, idx % per * sz, idx // per])
+            else:
+                first, off = table.find(idx * sz)
+                spans.append([first, off, table.find(idx * sz + sz - 1)[0]])
+        chunks = sorted(set([chunk for first, off, last in spans for chunk in range(first, last + 1)]))
+        views = dict(zip(chunks, self.doc.rep.manager.fetch_view_many([table.id(chunk) for chunk in chunks])))
+        items = []
+        for first, off, last in spans:
+            if first == last:
+                items.append(bytes(views[first][off:off+sz]))
+            else:
+                item = bytearray(views[first][off:])
+                for chunk in range(first + 1, last + 1):
+                    item += views[chunk][:sz-len(item)]
+                items.append(bytes(item))
+        return items
+    def _unsentineled(self, sentinel, batch):
+        # yields the start of each batch of items, a view of them, and the
+        # indices in it of those that are not sentinel
+        sz = self._itemsize
+        if sentinel is None:
+            sentinel = bytes(sz)
+        buffer = bytearray(batch * sz)
+        for start in range(0, len(self), batch):
+            count = self.readinto(buffer, start, start + batch)
+            view = memoryview(buffer)[:count*sz]
+            if numpy is not None:
+                items = numpy.frombuffer(view, numpy.uint8).reshape(count, sz)
+                found = numpy.flatnonzero((items != numpy.frombuffer(sentinel, numpy.uint8)).any(axis=1)).tolist()
+            else:
+                found = [idx for idx in range(count) if view[idx*sz:(idx+1)*sz] != sentinel]
+            yield start, view, found
+    def occupied(self, sentinel=None, batch=1<<16):
+        # yields [index, item] for each item that is not sentinel, zeros by
+        # default, reading batch items at a time
+        sz = self._itemsize
+        for start, view, found in self._unsentineled(sentinel, batch):
+            for idx in found:
+                yield [start + idx, bytes(view[idx*sz:(idx+1)*sz])]
+    def occupancy(self, sentinel=None, batch=1<<16):
+        # the number of items that are not sentinel
+        return sum([len(found) for start, view, found in self._unsentineled(sentinel, batch)])
     def index_to_id(self, index):
         id = self.doc.offset_to_id(index * sz)
         assert self.doc.offset_to_id(index * sz + sz - 1) == id
@@ -34,7 +148,7 @@ class FixedArray(collections.abc.MutableSequence):
                 buf += region
                 szminusbuflen -= regionlen
                 continue
-            yield buf + region[:szminusbuflen]
+            yield bytes(buf) + region[:szminusbuflen]
             buflen = (regionlen - szminusbuflen) % sz
             tailoff = regionlen - buflen
             for off in range(szminusbuflen, tailoff, sz):
@@ -52,52 +166,119 @@ class FixedArray(collections.abc.MutableSequence):
             start, stop, step = slice.indices(len(self))
         sz = self._itemsize
         dbg_startlen = len(self)
-        data = IterableToBytes(len(values) * sz, values)
-        self.doc[start * sz : stop * sz] = data
+        if self.aligned:
+            self._set_aligned(start, stop, values)
+        else:
+            data = IterableToBytes(len(values) * sz, values)
+            self.doc[start * sz : stop * sz] = data
         assert len(self) == dbg_startlen + len(values) - (stop - start)
+    def _set_aligned(self, start, stop, values):
+        # rewrites the chunks holding items start:stop, or every chunk from
+        # the first of them if the length changes
+        sz = self._itemsize
+        per = self.doc._allocsize // sz
+        table = self.doc._table
+        data = b''.join(values)
+        assert len(data) == len(values) * sz
+        if not data and stop == start:
+            return
+        start_idx = start // per
+        if len(values) == stop - start:
+            stop_idx = (stop - 1) // per + 1
+        else:
+            stop_idx = len(table)
+        old = b''.join(self.doc.rep.manager.fetch_many(table.ids(start_idx, stop_idx)))
+        base = start_idx * per
+        content = old[:(start-base)*sz] + data + old[(stop-base)*sz:]
+        self.doc.replace_chunks(start_idx, stop_idx, [
+            content[off:off+per*sz]
+            for off in range(0, len(content), per*sz)
+        ])
     def __delitem__(self, slice):
         self[slice] = []
     def insert(self, idx, value):
         self[idx:idx] = [value]
-    #def update(self, idxvaluesdict, **idxvalueskws):
-    #        # this is kind of a lot of implementations
-    #    #self.doc.update([
-    #    #    [start * sz, stop * sz, data]
-    #    #])
-    #    idxvalues = list(dict(idxvaluesdict).items()) + list(idxvalueskws.items())
-    #    idxvalues.sort()
-    #    last_idx = 0
-    #    for idx, value in idxvalues:
-            
+    def update(self, idxvalues):
+        # writes the values of a dict or sequence of [index, value] pairs,
+        # the last value of a repeated index winning. each chunk holding any
+        # index is fetched and patched once, and all patched chunks are
+        # allocated in one batch. returns the number of chunks rewritten.
+        if not isinstance(idxvalues, dict):
+            idxvalues = dict(idxvalues)
+        sz = self._itemsize
+        length = len(self)
+        idxvalues = sorted(idxvalues.items(), key=lambda idxvalue: idxvalue[0])
+        for idx, value in idxvalues:
+            if idx < 0 or idx >= length:
+                raise IndexError('index out of range')
+            assert len(value) == sz
+        if not self.aligned:
+            return self.doc.update(*[
+                [idx * sz, (idx + 1) * sz, value]
+                for idx, value in idxvalues
+            ])
+        per = self.doc._allocsize // sz
+        groups = {} # chunk -> [index, value] pairs
+        for idx, value in idxvalues:
+            groups.setdefault(idx // per, []).append([idx, value])
+        table = self.doc._table
+        chunks = list(groups)
+        old_ids = [table.id(chunk) for chunk in chunks]
+        pieces = []
+        for chunk, data in zip(chunks, self.doc.rep.manager.fetch_many(old_ids)):
+            data = bytearray(data)
+            for idx, value in groups[chunk]:
+                off = idx % per * sz
+                data[off:off+sz] = value
+            pieces.append(bytes(data))
+        new_ids = self.doc.rep.manager.alloc_many(pieces, replacing=old_ids)
+        for chunk, id, piece in zip(chunks, new_ids, pieces):
+            table.replace(chunk, chunk + 1, [id], [len(piece)])
+        if self.doc.fsck_edits:
+            self.doc.fsck()
+        return len(chunks)
+    def rewrite(self):
+        return self.doc.rewrite()
     @property
     def itemsize(self):
         return self._itemsize
     def mutate_all(self, mutator):
         length = len(self)
-        self.doc[:] = b''.join([
+        data = b''.join([
             mutator(value) for value in self
         ])
-        self._itemsize = len(self.doc) // length
-        assert self._itemsize * length == len(self.doc)
+        self._itemsize = len(data) // length
+        assert self._itemsize * length == len(data)
+        chunk = self.doc._allocsize // self._itemsize * self._itemsize
+        if self.aligned and chunk:
+            self.doc.replace_chunks(0, len(self.doc._table), [
+                data[off:off+chunk]
+                for off in range(0, len(data), chunk)
+            ])
+        else:
+            self.doc[:] = data
+            self.aligned = False
 
 class Array(FixedArray):
-    def __init__(self, id=b'', rep=None):
+    # items are fetched and allocated through the rep's pipeline, a window
+    # at a time in order, concurrently on its executor if it has one
+    def __init__(self, id=b'', rep=None, sized=False, paged=False, aligned=False):
         if rep is None:
             rep = Rep()
-        super().__init__(rep.manager.idsize, id, rep)
+        super().__init__(rep.manager.idsize, id, rep, sized, paged, aligned)
+        rep = self.doc.rep
         self._alloc = rep.manager.alloc
+        self._alloc_many = rep.manager.alloc_many
         self._fetch = rep.manager.fetch
+        self._fetch_many = rep.manager.fetch_many
         self._dealloc = rep.manager.dealloc
     def __getitem__(self, slice):
-        fetch = self._fetch
         if type(slice) is int:
-            return fetch(super().__getitem__(slice))
+            return self._fetch(super().__getitem__(slice))
         else:
-            return [fetch(id) for id in super().__getitem__(slice)]
+            return list(self.doc.rep._pipeline(self._fetch, self._fetch_many, super().__getitem__(slice)))
     def __iter__(self):
-        fetch = self._fetch
-        for id in super().__iter__():
-            yield fetch(id)
+        return self.doc.rep._pipeline(self._fetch, self._fetch_many, super().__iter__())
     def __setitem__(self, slice, values):
         alloc = self._alloc
         dealloc = self._dealloc
@@ -106,12 +287,84 @@ class Array(FixedArray):
             super().__setitem__(slice, alloc(values, replacing=old_ids))
         else:
             old_ids = super().__getitem__(slice)
-            super().__setitem__(slice, IterableWithLength((alloc(value, replacing=old_ids) for value in values), len(values)))
+            super().__setitem__(slice, list(self.doc.rep._pipeline(
+                lambda value: alloc(value, replacing=old_ids),
+                lambda values: self._alloc_many(values, replacing=old_ids),
+                values)))
         for old_id in old_ids:
             dealloc(old_id)
+    def rewrite(self):
+        # items are ids too, so they are rewritten before the chunks holding them
+        retire = getattr(self.doc.rep.manager, 'retire', None)
+        if retire is None:
+            return 0
+        changed = 0
+        for idx, id in enumerate(list(super().__iter__())):
+            new_id = retire(id)
+            if new_id != id:
+                FixedArray.__setitem__(self, idx, new_id)
+                changed += 1
+        return changed + super().rewrite()
 
 if __name__ == '__main__':
     import random, time, tqdm
+    import atexit, os, tempfile
+    from .i import fI
+    with tempfile.TemporaryDirectory() as dir:
+        # single item writes, aligned and not
+        store = fI(os.path.join(dir, 'array.d'))
+        atexit.unregister(store.shrink)
+        random.seed(0)
+        for aligned in [False, True]:
+            items = FixedArray(24, rep=Rep(store), aligned=aligned)
+            items[:] = [random.randbytes(24) for x in range(1 << 16)]
+            cmp = list(items)
+            start = time.perf_counter()
+            for it in range(2000):
+                idx = random.randrange(len(items))
+                items[idx] = cmp[idx] = random.randbytes(24)
+            duration = time.perf_counter() - start
+            assert list(items) == cmp
+            print('aligned' if aligned else 'unaligned', f'{duration/2000*1000000:.0f}us per item write')
+            # scattered writes together
+            updates = {random.randrange(len(items)): random.randbytes(24) for x in range(2000)}
+            start = time.perf_counter()
+            chunks = items.update(updates)
+            duration = time.perf_counter() - start
+            for idx, item in updates.items():
+                cmp[idx] = item
+            assert list(items) == cmp
+            print(f'  update: {duration/len(updates)*1000000:.0f}us per item, {chunks} chunks')
+            # a repeated index keeps its last value
+            items.update([[0, bytes(24)], [len(items) - 1, bytes(24)], [0, cmp[0]]])
+            assert items[0] == cmp[0] and items[len(items) - 1] == bytes(24)
+            cmp[-1] = bytes(24)
+        # a sparse table scanned for occupied slots
+        items = FixedArray(24, rep=Rep(store))
+        items[:] = [random.randbytes(24) if random.random() < 0.1 else bytes(24) for x in range(1 << 18)]
+        start = time.perf_counter()
+        found = [[idx, item] for idx, item in enumerate(items) if item != bytes(24)]
+        duration = time.perf_counter() - start
+        start = time.perf_counter()
+        assert list(items.occupied()) == found
+        print(f'scan: iterating {duration:.3f}s, occupied {time.perf_counter()-start:.3f}s', 'with numpy' if numpy else '')
+        idxs = [random.randrange(len(items)) for x in range(1000)]
+        assert items.take(idxs) == [items[idx] for idx in idxs]
+        # paged chunks whose counts and totals look aligned but are not
+        data = random.randbytes(24 * 20000)
+        pieces = []
+        off = 0
+        while off < len(data):
+            pieces.append(data[off:off+store.allocsize-len(pieces)%2*16])
+            off += len(pieces[-1])
+        doc = ResizeableDocument(rep=Rep(store), paged=True)
+        doc.replace_chunks(0, 0, pieces)
+        items = FixedArray(24, doc.id, Rep(store), aligned=True)
+        assert not items.aligned and items[:] == [data[off:off+24] for off in range(0, len(data), 24)]
+        items = FixedArray(24, rep=Rep(store), paged=True, aligned=True)
+        items[:] = [data[off:off+24] for off in range(0, len(data), 24)]
+        assert FixedArray(24, items.id, Rep(store), aligned=True).aligned
+        store.shrink()
     for seed in [1745318607,int(time.time())]:
         print(f'random.seed({seed})')
         random.seed(seed)
@@ -0,0 +1,248 @@
+import collections
+from threading import Lock
+
+from .manager import Manager, Wrapper
+
+class Cached(Wrapper):
+    # keeps fetched data in front of another manager. data is kept in memory
+    # up to size bytes, least recently used first out, and optionally in an
+    # fI on disk that lasts across runs, up to disk_size bytes. the disk
+    # stores the source id ahead of each item, so its index is rebuilt from
+    # the heads of its allocations when opened.
+    def __init__(self, manager, size=1<<26, disk=None, disk_size=1<<30):
+        super().__init__(manager)
+        self.size = size
+        self.used = 0
+        self.disk = disk
+        self.disk_size = disk_size
+        self.disk_used = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lru = collections.OrderedDict() # id -> data
+        self._lock = Lock()
+        self._disk_ids = collections.OrderedDict() # id -> [disk id, stored size]
+        if disk is not None:
+            disk_ids = list(disk.ids())
+            heads = disk.fetch_range_many(disk_ids, 0, self.idsize)
+            for disk_id, id, size in zip(disk_ids, heads, disk.fetch_size_many(disk_ids)):
+                self._disk_ids[id] = [disk_id, size]
+                self.disk_used += size
+            self._trim_disk()
+        if hasattr(manager, 'retire'):
+            self.retire = self._retire
+    # views are made from cached data
+    fetch_view = Manager.fetch_view
+    fetch_view_many = Manager.fetch_view_many
+    def _remember(self, id, data):
+        with self._lock:
+            old = self._lru.pop(id, None)
+            if old is not None:
+                self.used -= len(old)
+            if len(data) > self.size:
+                return
+            self._lru[id] = data
+            self.used += len(data)
+            while self.used > self.size:
+                self.used -= len(self._lru.popitem(last=False)[1])
+    def _forget(self, id):
+        with self._lock:
+            old = self._lru.pop(id, None)
+            if old is not None:
+                self.used -= len(old)
+            disk_id = self._disk_ids.pop(id, None)
+            if disk_id is not None:
+                disk_id, size = disk_id
+                self.disk_used -= size
+        if disk_id is not None:
+            self.disk.dealloc(disk_id)
+    def _trim_disk(self):
+        # deallocs the least recently used items on disk past disk_size
+        evicted = []
+        with self._lock:
+            while self.disk_used > self.disk_size:
+                disk_id, size = self._disk_ids.popitem(last=False)[1]
+                self.disk_used -= size
+                evicted.append(disk_id)
+        for disk_id in evicted:
+            self.disk.dealloc(disk_id)
+    def _store(self, id, data):
+        self._remember(id, data)
+        size = self.idsize + len(data)
+        if self.disk is not None and id not in self._disk_ids and size <= self.disk_size:
+            disk_id = self.disk.alloc(id + data)
+            with self._lock:
+                if id in self._disk_ids:
+                    self.disk.dealloc(disk_id)
+                    return
+                self._disk_ids[id] = [disk_id, size]
+                self.disk_used += size
+            self._trim_disk()
+    def _cached(self, id):
+        # the data for id if cached, else None
+        with self._lock:
+            data = self._lru.get(id)
+            if data is not None:
+                self._lru.move_to_end(id)
+                self.hits += 1
+                return data
+            disk_id = self._disk_ids.get(id)
+            if disk_id is not None:
+                self._disk_ids.move_to_end(id)
+                disk_id = disk_id[0]
+        if disk_id is not None:
+            data = self.disk.fetch(disk_id)
+            # the item may have been evicted and its space reused meanwhile
+            if data[:self.idsize] == id:
+                data = data[self.idsize:]
+                self._remember(id, data)
+                with self._lock:
+                    self.disk_hits += 1
+                return data
+        return None
+    def alloc(self, data, replacing=[]):
+        id = self.manager.alloc(data, replacing=replacing)
+        self._forget(id)
+        self._remember(id, bytes(data))
+        return id
+    def alloc_many(self, datas, replacing=[]):
+        datas = list(datas)
+        ids = self.manager.alloc_many(datas, replacing=replacing)
+        for id, data in zip(ids, datas):
+            self._forget(id)
+            self._remember(id, bytes(data))
+        return ids
+    def dealloc(self, id):
+        self._forget(id)
+        super().dealloc(id)
+    def _retire(self, id):
+        # the old id may be reused once retired
+        new_id = self.manager.retire(id)
+        if new_id != id:
+            self._forget(id)
+        return new_id
+    def fetch(self, id):
+        data = self._cached(id)
+        if data is None:
+            with self._lock:
+                self.misses += 1
+            data = self.manager.fetch(id)
+            self._store(id, data)
+        return data
+    def fetch_many(self, ids):
+        ids = list(ids)
+        datas = [self._cached(id) for id in ids]
+        missing = [idx for idx, data in enumerate(datas) if data is None]
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            fetched = self.manager.fetch_many([ids[idx] for idx in missing])
+            for idx, data in zip(missing, fetched):
+                datas[idx] = data
+                self._store(ids[idx], data)
+        return datas
+    def fetch_range(self, id, start, stop):
+        # a partial read fetches and caches the whole, so later reads of
+        # the same chunk, as of table slots, are served from the cache
+        return self.fetch(id)[start:stop]
+    def fetch_range_many(self, ids, start, stop):
+        return [data[start:stop] for data in self.fetch_many(ids)]
+    def fetch_size(self, id):
+        with self._lock:
+            data = self._lru.get(id)
+            disk_id = self._disk_ids.get(id)
+        if data is not None:
+            return len(data)
+        if disk_id is not None:
+            return disk_id[1] - self.idsize
+        return self.manager.fetch_size(id)
+    def fetch_size_many(self, ids):
+        ids = list(ids)
+        sizes = [None] * len(ids)
+        missing = []
+        for idx, id in enumerate(ids):
+            with self._lock:
+                data = self._lru.get(id)
+                disk_id = self._disk_ids.get(id)
+            if data is not None:
+                sizes[idx] = len(data)
+            elif disk_id is not None:
+                sizes[idx] = disk_id[1] - self.idsize
+            else:
+                missing.append(idx)
+        if missing:
+            for idx, size in zip(missing, self.manager.fetch_size_many([ids[idx] for idx in missing])):
+                sizes[idx] = size
+        return sizes
+
+if __name__ == '__main__':
+    import atexit, os, random, tempfile, time
+    from .i import fI
+    from .rep import Rep
+    from .dict import Dict
+    from .manager import Slow
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as dir:
+        source = fI(os.path.join(dir, 'source.d'))
+        atexit.unregister(source.shrink)
+        items = { random.randbytes(8): random.randbytes(random.randint(1, 64)) for x in range(256) }
+        dict_id = None
+        for size, disk in [[None, None], [1<<20, None], [1<<20, 'cache.d'], [1<<20, 'cache.d']]:
+            slow = Slow(source)
+            if size is None:
+                manager = slow
+            else:
+                if disk is not None:
+                    disk = fI(os.path.join(dir, disk))
+                    atexit.unregister(disk.shrink)
+                manager = Cached(slow, size=size, disk=disk)
+            rep = Rep(manager)
+            if dict_id is None:
+                doc = Dict(rep=rep)
+                doc.update(items)
+                dict_id = doc.id
+            doc = Dict(dict_id, rep=rep)
+            start = time.perf_counter()
+            for it in range(4):
+                for key, value in random.sample(list(items.items()), 64):
+                    assert doc[key] == value
+            duration = time.perf_counter() - start
+            print('uncached' if size is None else 'memory' if disk is None else 'memory and disk',
+                  f'{duration*1000:.0f}ms', f'{slow.fetches} fetches from source', end=' ')
+            if size is None:
+                print()
+            else:
+                print(f'hits {manager.hits} disk hits {manager.disk_hits} misses {manager.misses}')
+            if disk is not None:
+                disk.shrink()
+        # repeated lookups of one key are fetched once
+        slow = Slow(source)
+        doc = Dict(dict_id, rep=Rep(Cached(slow)))
+        key, value = next(iter(items.items()))
+        slow.fetches = 0
+        for it in range(10):
+            assert doc[key] == value
+        assert slow.fetches <= 3
+        # the disk keeps at most disk_size bytes, and reopens within it
+        disk = fI(os.path.join(dir, 'bounded.d'))
+        atexit.unregister(disk.shrink)
+        manager = Cached(source, size=1<<10, disk=disk, disk_size=1<<12)
+        doc = Dict(dict_id, rep=Rep(manager))
+        for key, value in items.items():
+            assert doc[key] == value
+        assert 0 < manager.disk_used <= manager.disk_size
+        assert manager.disk_used == sum(disk.fetch_size(disk_id) for disk_id in disk.ids())
+        reopened = Cached(source, size=1<<10, disk=disk, disk_size=1<<11)
+        assert reopened.disk_used <= reopened.disk_size and len(list(disk.ids())) == len(reopened._disk_ids)
+        for id in list(reopened._disk_ids):
+            assert reopened.fetch(id) == source.fetch(id)
+        disk.shrink()
+        # dealloc invalidates
+        manager = Cached(source, size=1<<10)
+        id = manager.alloc(b'old')
+        assert manager.fetch(id) == b'old'
+        manager.dealloc(id)
+        id2 = manager.alloc(b'new')
+        assert id2 != id or manager.fetch(id) == b'new'
+        assert manager.used <= manager.size
+        source.shrink()
@@ -0,0 +1,35 @@
+import random
+
+_random = random.Random(0)
+_gear = [_random.getrandbits(64) for x in range(256)]
+
+class Chunker:
+    # cuts data where its content says to, so an edit only changes the
+    # chunks around it. a gear hash rolls over the data and a chunk ends
+    # where its top bits are zero. chunks average about average bytes and
+    # are never shorter than a quarter of that, except at the end of data.
+    def __init__(self, average=1<<11):
+        self.average = average
+        self.minimum = average // 4
+        bits = max((average - self.minimum).bit_length() - 1, 1)
+        self._mask = ((1 << bits) - 1) << (64 - bits)
+    def cut(self, data, limit):
+        # the length of the first chunk of data, at most limit
+        length = min(len(data), limit)
+        if length <= self.minimum:
+            return length
+        gear = _gear
+        mask = self._mask
+        hash = 0
+        for idx in range(self.minimum, length):
+            hash = ((hash << 1) + gear[data[idx]]) & 0xffffffffffffffff
+            if not hash & mask:
+                return idx + 1
+        return length
+    def split(self, data, limit):
+        # yields the chunks of data, each at most limit long
+        data = memoryview(data)
+        while len(data):
+            length = self.cut(data, limit)
+            yield data[:length]
+            data = data[length:]
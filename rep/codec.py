@@ -0,0 +1,183 @@
+import collections, lzma, zlib
+from threading import Lock
+
+from .manager import Manager, Wrapper
+from .rep import Rep
+
+class Compressed(Wrapper):
+    # compresses each chunk in front of another manager. a compressed chunk
+    # starts with a marker, a codec number and its length uncompressed.
+    # chunks that do not shrink are stored as they are, so stores holding
+    # chunks from before compression was used keep working. uncompressed
+    # data that happens to start with the marker is stored with the raw codec.
+    # chunks compressed with a preset dictionary have their own codec, and
+    # the adler32 of the dictionary after the length. dictionaries are stored
+    # in the manager behind by store_zdict, and passed back by id.
+    # sizes and offsets are all in uncompressed bytes.
+    _marker = b'\x8erZc'
+    _raw, _zlib, _lzma, _zdict = range(4)
+    _header = len(_marker) + 1 + 4
+    _lzma_filters = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+    def __init__(self, manager, codec='zlib', level=9, zdict=None, zdicts=[]):
+        super().__init__(manager)
+        self.allocsize = manager.allocsize - self._header
+        self.codec = codec
+        self.level = level
+        self.zdict = None # the dictionary small chunks are compressed with
+        self.bytes_in = 0
+        self.bytes_stored = 0
+        self._lock = Lock()
+        self._zdicts = {} # adler32 -> dictionary, for decoding
+        # zdict is the id of the dictionary to compress with, zdicts the
+        # ids of any others that stored chunks were compressed with
+        for id in zdicts:
+            self._load_zdict(id)
+        if zdict is not None:
+            self.zdict = self._load_zdict(zdict)
+            self._zdict_adler32 = zlib.adler32(self.zdict)
+    # ranges and views are of the decoded data
+    fetch_range = Manager.fetch_range
+    fetch_range_many = Manager.fetch_range_many
+    fetch_view = Manager.fetch_view
+    fetch_view_many = Manager.fetch_view_many
+    @staticmethod
+    def train(samples, size=1<<15, length=8):
+        # a preset dictionary for zlib from the substrings most common in
+        # samples. the most common go last, where zlib reaches them cheapest.
+        counts = collections.Counter()
+        for sample in samples:
+            sample = bytes(sample)
+            for off in range(0, len(sample) - length + 1, length // 2):
+                counts[sample[off:off+length]] += 1
+        common = [piece for piece, count in counts.most_common(size // length) if count > 1]
+        return b''.join(reversed(common))
+    @staticmethod
+    def store_zdict(manager, zdict):
+        # stores a dictionary from train uncompressed, returning its id
+        return Rep(manager).alloc(zdict)
+    def _load_zdict(self, id):
+        zdict = Rep(self.manager).fetch(id)
+        self._zdicts[zlib.adler32(zdict)] = zdict
+        return zdict
+    def _compress(self, data):
+        if self.codec == 'lzma':
+            return self._lzma, lzma.compress(data, format=lzma.FORMAT_RAW, filters=self._lzma_filters)
+        if self.zdict is not None:
+            compressor = zlib.compressobj(self.level, zdict=self.zdict)
+            compressed = compressor.compress(data) + compressor.flush()
+            return self._zdict, self._zdict_adler32.to_bytes(4, 'little') + compressed
+        return self._zlib, zlib.compress(data, self.level)
+    def encode(self, data):
+        data = bytes(data)
+        codec, compressed = self._compress(data)
+        if len(compressed) + self._header < len(data):
+            encoded = self._marker + bytes([codec]) + len(data).to_bytes(4, 'little') + compressed
+        elif data[:len(self._marker)] == self._marker:
+            encoded = self._marker + bytes([self._raw]) + len(data).to_bytes(4, 'little') + data
+        else:
+            encoded = data
+        with self._lock:
+            self.bytes_in += len(data)
+            self.bytes_stored += len(encoded)
+        return encoded
+    def decode(self, encoded):
+        if encoded[:len(self._marker)] != self._marker:
+            return encoded
+        codec = encoded[len(self._marker)]
+        length = int.from_bytes(encoded[len(self._marker)+1:self._header], 'little')
+        payload = encoded[self._header:]
+        if codec == self._raw:
+            data = payload
+        elif codec == self._zlib:
+            data = zlib.decompress(payload)
+        elif codec == self._zdict:
+            adler32 = int.from_bytes(payload[:4], 'little')
+            zdict = self._zdicts.get(adler32)
+            if zdict is None:
+                raise KeyError(f'no dictionary with adler32 {adler32:08x}, pass its id in zdicts')
+            decompressor = zlib.decompressobj(zdict=zdict)
+            data = decompressor.decompress(payload[4:]) + decompressor.flush()
+        elif codec == self._lzma:
+            data = lzma.decompress(payload, format=lzma.FORMAT_RAW, filters=self._lzma_filters)
+        else:
+            raise ValueError(f'unknown codec {codec}')
+        assert len(data) == length
+        return bytes(data)
+    def _size(self, head):
+        # the uncompressed size from the start of a chunk
+        if head[:len(self._marker)] == self._marker:
+            return int.from_bytes(head[len(self._marker)+1:self._header], 'little')
+        if len(head) < self._header:
+            return len(head)
+        return None
+    def alloc(self, data, replacing=[]):
+        return self.manager.alloc(self.encode(data), replacing=replacing)
+    def alloc_many(self, datas, replacing=[]):
+        return self.manager.alloc_many([self.encode(data) for data in datas], replacing=replacing)
+    def fetch(self, id):
+        return self.decode(self.manager.fetch(id))
+    def fetch_many(self, ids):
+        return [self.decode(data) for data in self.manager.fetch_many(ids)]
+    def fetch_size(self, id):
+        return self.fetch_size_many([id])[0]
+    def fetch_size_many(self, ids):
+        ids = list(ids)
+        heads = self.manager.fetch_range_many(ids, 0, self._header)
+        sizes = [self._size(head) for head in heads]
+        missing = [idx for idx, size in enumerate(sizes) if size is None]
+        if missing:
+            for idx, size in zip(missing, self.manager.fetch_size_many([ids[idx] for idx in missing])):
+                sizes[idx] = size
+        return sizes
+
+if __name__ == '__main__':
+    import atexit, os, random, tempfile, time
+    from .i import fI
+    from .rep import Rep, ResizeableDocument
+    from .dict import Dict
+    random.seed(0)
+    words = [bytes(random.choices(b'abcdefghijklmnopqrstuvwxyz', k=random.randint(2, 9))) for x in range(2000)]
+    text = b' '.join(random.choices(words, k=200000))
+    with tempfile.TemporaryDirectory() as dir:
+        store = fI(os.path.join(dir, 'codec.d'))
+        atexit.unregister(store.shrink)
+        plain = ResizeableDocument(rep=Rep(store))
+        plain += text
+        zdict = Compressed.train([text[off:off+store.allocsize] for off in range(0, 1<<18, store.allocsize)])
+        zdict_id = Compressed.store_zdict(store, zdict)
+        for codec, zdict in [['zlib', None], ['zlib', zdict_id], ['lzma', None]]:
+            manager = Compressed(store, codec, zdict=zdict)
+            rep = Rep(manager)
+            start = time.perf_counter()
+            doc = ResizeableDocument(rep=rep)
+            doc += text
+            table = Dict(rep=rep)
+            table.update({ word: word.upper() for word in words[:300] })
+            duration = time.perf_counter() - start
+            # chunks stored uncompressed read back through the codec
+            mixed = ResizeableDocument(plain.id + doc.id, rep)
+            assert mixed[:] == text + text
+            assert ResizeableDocument(doc.id, rep)[:] == text
+            assert dict(Dict(table.id, rep).items()) == { word: word.upper() for word in words[:300] }
+            print(codec, 'with dictionary' if zdict else '',
+                  f'stored {manager.bytes_stored} of {manager.bytes_in} bytes',
+                  f'ratio {manager.bytes_in/manager.bytes_stored:.2f}',
+                  f'{duration:.2f}s')
+            if zdict is not None:
+                zdict_doc = doc.id
+        # chunks compressed with a dictionary need it passed back by id
+        try:
+            ResizeableDocument(zdict_doc, Rep(Compressed(store)))[:]
+            assert not 'decoded without its dictionary'
+        except KeyError:
+            pass
+        other_id = Compressed.store_zdict(store, Compressed.train([text[:1<<16:3]]))
+        manager = Compressed(store, zdict=other_id, zdicts=[zdict_id])
+        assert ResizeableDocument(zdict_doc, Rep(manager))[:] == text
+        assert manager.fetch(manager.alloc(text[:1000])) == text[:1000]
+        # raw chunks starting with the marker round trip
+        manager = Compressed(store)
+        data = Compressed._marker + os.urandom(64)
+        assert manager.fetch(manager.alloc(data)) == data
+        assert manager.fetch_size(manager.alloc(data)) == len(data)
+        store.shrink()
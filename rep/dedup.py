@@ -0,0 +1,239 @@
+import hashlib
+from threading import Lock
+
+from .manager import Manager, Wrapper
+
+class Deduped(Wrapper):
+    # allocates each distinct chunk once in front of another manager. chunks
+    # are found by digest, and an id is deallocated when the last of its
+    # allocations is. the index is kept in memory, so ids from earlier runs
+    # are not shared with new chunks. they may be shared among themselves,
+    # so deallocating one only counts it in leaked, and retiring one leaves
+    # its forwarded regions in place.
+    def __init__(self, manager, digest=hashlib.sha256):
+        super().__init__(manager)
+        self.digest = digest
+        self.bytes_in = 0 # bytes passed to alloc
+        self.bytes_saved = 0 # bytes found already allocated
+        self.chunks_in = 0
+        self.chunks_saved = 0
+        self.leaked = 0 # deallocs of ids from earlier runs, left allocated
+        self._ids = {} # digest -> id
+        self._digests = {} # id -> digest
+        self._refs = {} # id -> allocation count
+        self._lock = Lock()
+        if hasattr(manager, 'retire'):
+            self.retire = self._retire
+    @property
+    def ratio(self):
+        # bytes allocated per byte stored
+        stored = self.bytes_in - self.bytes_saved
+        return self.bytes_in / stored if stored else 1.0
+    def _find(self, digest, length):
+        # the id already holding a chunk, counting the new reference
+        with self._lock:
+            self.bytes_in += length
+            self.chunks_in += 1
+            id = self._ids.get(digest)
+            if id is not None:
+                self._refs[id] += 1
+                self.bytes_saved += length
+                self.chunks_saved += 1
+            return id
+    def _add(self, digest, id):
+        with self._lock:
+            other = self._ids.get(digest)
+            if other is not None:
+                # another thread stored the same chunk meanwhile
+                self._refs[other] += 1
+                return other, id
+            self._ids[digest] = id
+            self._digests[id] = digest
+            self._refs[id] = 1
+            return id, None
+    def alloc(self, data, replacing=[]):
+        digest = self.digest(data).digest()
+        id = self._find(digest, len(data))
+        if id is None:
+            id, extra = self._add(digest, self.manager.alloc(data, replacing=replacing))
+            if extra is not None:
+                self.manager.dealloc(extra)
+        return id
+    def alloc_many(self, datas, replacing=[]):
+        datas = list(datas)
+        digests = [self.digest(data).digest() for data in datas]
+        ids = [self._find(digest, len(data)) for digest, data in zip(digests, datas)]
+        missing = {}
+        for idx, id in enumerate(ids):
+            if id is None:
+                missing.setdefault(digests[idx], []).append(idx)
+        if missing:
+            new_ids = self.manager.alloc_many([datas[idxs[0]] for idxs in missing.values()], replacing=replacing)
+            for [digest, idxs], new_id in zip(missing.items(), new_ids):
+                id, extra = self._add(digest, new_id)
+                if extra is not None:
+                    self.manager.dealloc(extra)
+                for idx in idxs:
+                    ids[idx] = id
+                with self._lock:
+                    # repeats within the batch were not stored either
+                    self._refs[id] += len(idxs) - 1
+                    self.bytes_saved += len(datas[idxs[0]]) * (len(idxs) - 1)
+                    self.chunks_saved += len(idxs) - 1
+        return ids
+    def dealloc(self, id):
+        with self._lock:
+            refs = self._refs.get(id)
+            if refs is None:
+                # other references from an earlier run may remain
+                self.leaked += 1
+                return
+            if refs > 1:
+                self._refs[id] = refs - 1
+                return
+            del self._refs[id]
+            digest = self._digests.pop(id)
+            if self._ids[digest] == id:
+                del self._ids[digest]
+        self.manager.dealloc(id)
+    def _retire(self, id):
+        # each reference is retired separately. the old id stays forwarded
+        # until its last reference moves to the new one.
+        with self._lock:
+            refs = self._refs.get(id)
+            if refs is None:
+                return self.manager.resolve(id)
+            if refs > 1:
+                new_id = self.manager.resolve(id)
+            else:
+                new_id = self.manager.retire(id)
+            if new_id == id:
+                # not moved, every reference stays
+                return id
+            if refs > 1:
+                self._refs[id] = refs - 1
+                digest = self._digests[id]
+            else:
+                del self._refs[id]
+                digest = self._digests.pop(id)
+            self._ids[digest] = new_id
+            self._digests[new_id] = digest
+            self._refs[new_id] = self._refs.get(new_id, 0) + 1
+            return new_id
+
+if __name__ == '__main__':
+    import atexit, os, random, tempfile, time
+    from .i import fI
+    from .rep import Rep
+    from .chunk import Chunker
+    from .array import Array
+    class Counted(Manager):
+        # counts what reaches the stored manager
+        def __init__(self, manager):
+            self.manager = manager
+            self.idsize = manager.idsize
+            self.allocsize = manager.allocsize
+            self.sent = 0
+        def alloc(self, data, replacing=[]):
+            self.sent += len(data)
+            return self.manager.alloc(data, replacing=replacing)
+        def dealloc(self, id):
+            self.manager.dealloc(id)
+        def fetch(self, id):
+            return self.manager.fetch(id)
+        def fetch_size(self, id):
+            return self.manager.fetch_size(id)
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as dir:
+        store = fI(os.path.join(dir, 'dedup.d'))
+        atexit.unregister(store.shrink)
+        # a document edited in small places, stored whole after each edit
+        versions = [bytearray(random.randbytes(1 << 20))]
+        for version in range(16):
+            data = bytearray(versions[-1])
+            for edit in range(4):
+                off = random.randrange(len(data))
+                kind = random.randrange(3)
+                if kind == 0:
+                    data[off:off] = random.randbytes(random.randint(1, 64))
+                elif kind == 1:
+                    del data[off:off+random.randint(1, 64)]
+                else:
+                    data[off:off+8] = random.randbytes(8)
+            versions.append(data)
+        total = sum([len(data) for data in versions])
+        for chunker in [None, Chunker(1 << 11)]:
+            counted = Counted(store)
+            deduped = Deduped(counted)
+            rep = Rep(deduped, chunker=chunker)
+            start = time.perf_counter()
+            ids = [rep.alloc(bytes(data)) for data in versions]
+            duration = time.perf_counter() - start
+            for id, data in zip(ids, versions):
+                assert rep.fetch(id) == data
+            print('fixed' if chunker is None else 'content-defined',
+                  f'{total/duration/(1<<20):.1f}MiB/s',
+                  f'ratio {deduped.ratio:.2f}',
+                  f'saved {deduped.bytes_saved} of {deduped.bytes_in} bytes',
+                  f'{deduped.chunks_saved} of {deduped.chunks_in} chunks',
+                  f'sent {counted.sent}')
+            for id in ids:
+                sz = store.idsize
+                for off in range(0, len(id), sz):
+                    deduped.dealloc(id[off:off+sz])
+            assert not deduped._refs and not deduped._ids
+        # retiring a shared chunk that did not move keeps every reference
+        deduped = Deduped(store)
+        id = deduped.alloc(b'x' * 100)
+        assert deduped.alloc(b'x' * 100) == id
+        assert deduped.retire(id) == id
+        deduped.dealloc(id)
+        assert deduped.fetch(id) == b'x' * 100
+        deduped.dealloc(id)
+        assert not deduped._refs
+        # ids shared in an earlier run are left allocated when deallocated
+        arr_id = b''
+        for run in range(2):
+            deduped = Deduped(store)
+            arr = Array(arr_id, rep=Rep(deduped))
+            if not arr_id:
+                arr[:] = [b'shared value' * 10, b'shared value' * 10]
+                arr_id = arr.id
+            else:
+                arr[0] = b'\x0f'
+                assert deduped.leaked >= 1
+                # freed space would be taken by the next allocation
+                filler = store.alloc(b'\0' * 120)
+                assert arr[:] == [b'\x0f', b'shared value' * 10]
+                store.dealloc(filler)
+        # batch, range and view calls reach the manager behind as they are
+        class Probe(Wrapper):
+            def __init__(self, manager):
+                super().__init__(manager)
+                self.calls = []
+            def fetch_many(self, ids):
+                self.calls.append('fetch_many')
+                return super().fetch_many(ids)
+            def fetch_size_many(self, ids):
+                self.calls.append('fetch_size_many')
+                return super().fetch_size_many(ids)
+            def fetch_range(self, id, start, stop):
+                self.calls.append('fetch_range')
+                return super().fetch_range(id, start, stop)
+            def fetch_range_many(self, ids, start, stop):
+                self.calls.append('fetch_range_many')
+                return super().fetch_range_many(ids, start, stop)
+            def fetch_view_many(self, ids):
+                self.calls.append('fetch_view_many')
+                return super().fetch_view_many(ids)
+        probe = Probe(store)
+        deduped = Deduped(probe)
+        datas = [os.urandom(64) for x in range(4)]
+        ids = deduped.alloc_many(datas)
+        assert deduped.fetch_many(ids) == datas
+        assert deduped.fetch_size_many(ids) == [64] * 4
+        assert deduped.fetch_range(ids[0], 8, 16) == datas[0][8:16]
+        assert deduped.fetch_range_many(ids, 8, 16) == [data[8:16] for data in datas]
+        assert [bytes(view) for view in deduped.fetch_view_many(ids)] == datas
+        assert probe.calls == ['fetch_many', 'fetch_size_many', 'fetch_range', 'fetch_range_many', 'fetch_view_many']
+        store.shrink()
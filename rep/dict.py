@@ -35,10 +35,10 @@ def hash(bytes):
 class FixedDict(collections.abc.MutableMapping):
     # this approach expands on collisions.
     # so every fetch encounters at most one value, because collisions always make sparsity
-    def __init__(self, itemsize, key, id=b'', rep=None):
+    def __init__(self, itemsize, key, id=b'', rep=None, sized=False, paged=False, aligned=False):
         self._itemsize = itemsize
         self._key = key
-        self.array = FixedArray(self._itemsize, id, rep)
+        self.array = FixedArray(self._itemsize, id, rep, sized, paged, aligned)
         self._rep = self.array.doc.rep
         self._capacity = len(self.array)
         self._sentinel = bytes(self._itemsize)
@@ -120,27 +120,8 @@ class FixedDict(collections.abc.MutableMapping):
         updates.sort(reverse=True)
 
         if capacity == self._capacity: # no expansion, newidx == idx == superidx
-            allocsz = self._rep.manager.allocsize
-            itemsz = self._itemsize
-            update_chunks = [[updates.pop()]] if len(updates) else []
-            while len(updates):
-                update = updates.pop()
-                if (update[0] + 1 - update_chunks[-1][-1][0]) * itemsz >= allocsz:
-                    update_chunks.append([update])
-                else:
-                    update_chunks[-1].append(update)
-            for update_chunk in update_chunks:
-                if len(update_chunk) == 1:
-                    idx, keyhash, item = update_chunk[0]
-                    self.array[idx] = item
-                else:
-                    min_idx, min_keyhash, min_item = update_chunk[0]
-                    max_idx, max_keyhash, max_item = update_chunk[-1]
-                    content = [min_item] + self.array[min_idx+1:max_idx] + [max_item]
-                    for idx, keyhash, item in update_chunk[1:-1]:
-                        content[idx-min_idx] = item
-                    self.array[min_idx:max_idx+1] = content
-                update_chunk[:] = []
+            # the slots are written together, each chunk holding any once
+            self.array.update([[idx, item] for idx, keyhash, item in updates])
         else:
             # big-endian expand with sentinels, write entire array larger to spread zeros between items
             def content_generator():
@@ -184,19 +165,20 @@ class FixedDict(collections.abc.MutableMapping):
             self._hashshift = hashshift
             dict(FixedDict.__iter__(self)) # fsckish
     def __iter__(self):
-        for item in self.array:
-            if item != self._sentinel:
-                yield [self._key(item), item]
+        for idx, item in self.array.occupied(self._sentinel):
+            yield [self._key(item), item]
     def __delitem__(self, keyhash):
         idx = int.from_bytes(keyhash[:self._hashbytes], 'big') >> self._hashshift
         assert self.array[idx] != self._sentinel
         self.array[idx] = self._sentinel
+    def rewrite(self):
+        return self.array.rewrite()
 
 class Dict(FixedDict):
-    def __init__(self, id=b'', rep=None):
+    def __init__(self, id=b'', rep=None, sized=False, paged=False, aligned=False):
         if rep is None:
             rep = Rep()
-        super().__init__(rep.manager.idsize*2, self._key, id, rep)
+        super().__init__(rep.manager.idsize*2, self._key, id, rep, sized, paged, aligned)
         self._alloc = self._rep.manager.alloc
         self._fetch = self._rep.manager.fetch
         self._idsize = self._rep.manager.idsize
@@ -248,25 +230,34 @@ class Dict(FixedDict):
     def keys(self):
         sz = self._idsize
         fetch = self._fetch
-        sentinel = self._sentinel
-        for idx, storedkeyval in enumerate(self.array):
-            if storedkeyval != sentinel:
-                key = fetch(storedkeyval[:sz])
-                assert idx == int.from_bytes(hash(key)[:self._hashbytes], 'big') >> self._hashshift
-                yield key
+        for idx, storedkeyval in self.array.occupied(self._sentinel):
+            key = fetch(storedkeyval[:sz])
+            assert idx == int.from_bytes(hash(key)[:self._hashbytes], 'big') >> self._hashshift
+            yield key
     def values(self):
         raise NotImplementedError() # values implies not checking keyhashes
     def items(self):
         sz = self._idsize
         fetch = self._fetch
-        sentinel = self._sentinel
-        for idx, storedkeyval in enumerate(self.array):
-            if storedkeyval != sentinel:
-                key = fetch(storedkeyval[:sz])
-                assert idx == int.from_bytes(hash(key)[:self._hashbytes], 'big') >> self._hashshift
-                yield [key, fetch(storedkeyval[sz:])]
+        for idx, storedkeyval in self.array.occupied(self._sentinel):
+            key = fetch(storedkeyval[:sz])
+            assert idx == int.from_bytes(hash(key)[:self._hashbytes], 'big') >> self._hashshift
+            yield [key, fetch(storedkeyval[sz:])]
     def __iter__(self):
         return self.keys()
+    def rewrite(self):
+        # entries hold a key id and a value id, rewritten before the table
+        retire = getattr(self._rep.manager, 'retire', None)
+        if retire is None:
+            return 0
+        sz = self._idsize
+        changed = 0
+        for idx, storedkeyval in list(self.array.occupied(self._sentinel)):
+            newkeyval = retire(storedkeyval[:sz]) + retire(storedkeyval[sz:])
+            if newkeyval != storedkeyval:
+                self.array[idx] = newkeyval
+                changed += 1
+        return changed + super().rewrite()
     def __delitem__(self, key):
         keyhash = hash(key)
         storedkeyval = super().__getitem__(keyhash)
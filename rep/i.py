@@ -1,4 +1,6 @@
-import mmap, os
+import array, mmap, os, sys
+from threading import Lock, current_thread
+from .manager import Manager
 
 # current structure
 # offsets are in qwords which are usually 8 bytes
@@ -13,90 +15,687 @@ import mmap, os
 #   1q: bytes of data
 #   the total reserved space of an allocated region is rounded up to qwords
 #   with a minimum size of 2 qwords
+# forwarded region:
+#   0: qword containing 0xffffffffffffffff in place of a bytelength
+#   1q: global offset in qwords of the region the data was moved to
+#   this is left behind by compaction so that an old id still resolves.
+#   it is 2 qwords long and is freed on dealloc or retire of the old id.
 # id:
 #   a single qword containing the offset in qwords of an allocated region
 # all allocated regions can be found as the gaps between deallocated regions
+# the last region of the file is always deallocated, and is called the tail.
+#
+# free space index:
+#   the linked list is the persistent form. on open it is walked once and
+#   indexed in memory: every free region maps to the qword that points to it,
+#   and all but the tail are binned by size class so that alloc and dealloc
+#   do not walk the list. small classes hold exactly one length, larger
+#   classes each hold a power-of-two range of lengths.
+#   free regions are also indexed by the address they end at, so that a
+#   deallocated region is merged with free neighbours on both sides as soon
+#   as it is freed.
+#
+# threads:
+#   the index, the linked list and the mapping are changed under one lock.
+#   reads take their own view of the mapping and do not lock, so it is
+#   only resized in place when no read is in progress.
+#   each allocating thread holds an arena: a free region taken out of the
+#   bins but left in the linked list. small allocations are carved from the
+#   back of it without locking, as that only changes the arena's length,
+#   which no other thread writes. compact and shrink reclaim the arenas and
+#   should not run alongside allocation.
+#   compaction counts its passes in a number that is odd while regions are
+#   being moved. a read that copies data notes the number before it starts
+#   and, if it was odd or has changed when it is done, waits for the pass
+#   to end and reads again, as the data may have been moved and its old
+#   space reused meanwhile. a forwarded region's new address is written
+#   before its marker, and lengths are read once, so reads never follow a
+#   partly written forward. views from fetch_view are not checked, and are
+#   only meaningful until their id is deallocated or compacted.
+#
+# processes:
+#   with shared=True the lock also takes an fcntl lock on a file next to the
+#   store, which holds a count of changes and a log of the free regions
+#   each change touched, with their old lengths and new links and lengths.
+#   a process that finds the count moved since it last held the lock maps
+#   the file again at its current size and applies the log entries it
+#   missed to its index. the log starts over when it grows past logsize,
+#   and a process that missed entries that were dropped rebuilds its index
+#   from the linked list. arenas are not used, as other processes cannot
+#   see them. reads still do not lock, and map the file again if an id lies
+#   past the end of their mapping. every process holds a shared lock on
+#   another byte of the lock file while it has the store open, and shrink
+#   only truncates when it alone holds it. compact likewise only moves
+#   regions when it alone holds it, as reads in other processes cannot see
+#   its count of passes.
 
-class fI:
+class _FileLock:
+    # a thread lock that also locks a file shared between processes.
+    # the file starts with the generation, the generation the log starts
+    # at and the end of the log. each record in the log is a generation, the
+    # length of the store in qwords and a count of entries, followed by the
+    # entries of that change as qwords.
+    _head = 24
+    def __init__(self, n, sync, journal, logsize=1<<20):
+        import fcntl
+        self._fcntl = fcntl
+        self.lock = Lock()
+        self.d = os.open(n, os.O_RDWR | os.O_CREAT)
+        self.sync = sync # called with the records missed, or None to rebuild
+        self.journal = journal # returns the length and entries of a change
+        self.logsize = logsize
+        self.generation = None
+        self.start = None
+        self.end = None
+        fcntl.lockf(self.d, fcntl.LOCK_SH, 1, 1)
+    def _acquire(self, cmd):
+        # lock, and sync if another process has made changes since
+        self.lock.acquire()
+        try:
+            self._fcntl.lockf(self.d, cmd, 1, 0)
+            head = os.pread(self.d, self._head, 0).ljust(self._head, b'\0')
+            generation, start, end = memoryview(head).cast('Q')
+            if generation != self.generation:
+                self.sync(self._records(generation, start, end))
+                self.generation = generation
+            self.start = start
+            self.end = max(end, self._head)
+        except:
+            self._release()
+            raise
+    def _records(self, generation, start, end):
+        # [yq, entries] for each change since ours, or None if the log
+        # no longer holds them all
+        if self.generation is None or start > self.generation + 1:
+            return None
+        off = self._head if start == self.generation + 1 else self.end
+        if off > end:
+            return None
+        log = memoryview(os.pread(self.d, end - off, off)).cast('Q')
+        records = []
+        record_generation = self.generation
+        idx = 0
+        while idx < len(log):
+            record_generation, yq, count = log[idx:idx+3]
+            records.append([yq, log[idx+3:idx+3+count*4]])
+            idx += 3 + count * 4
+        if record_generation != generation:
+            return None
+        return records
+    def __enter__(self):
+        self._acquire(self._fcntl.LOCK_EX)
+        return self
+    def __exit__(self, *exc_info):
+        self.generation += 1
+        yq, entries = self.journal()
+        record = array.array('Q', [self.generation, yq, len(entries) // 4]) + entries
+        if self.end + len(record) * 8 > self.logsize:
+            self.start = self.generation
+            self.end = self._head
+        os.pwrite(self.d, record.tobytes(), self.end)
+        self.end += len(record) * 8
+        os.pwrite(self.d, array.array('Q', [self.generation, self.start, self.end]).tobytes(), 0)
+        self._release()
+    def refresh(self):
+        # sync without making changes
+        self._acquire(self._fcntl.LOCK_SH)
+        self._release()
+    def _release(self):
+        self._fcntl.lockf(self.d, self._fcntl.LOCK_UN, 1, 0)
+        self.lock.release()
+    def alone(self):
+        # whether no other process has the store open
+        try:
+            self._fcntl.lockf(self.d, self._fcntl.LOCK_EX | self._fcntl.LOCK_NB, 1, 1)
+        except OSError:
+            return False
+        self._fcntl.lockf(self.d, self._fcntl.LOCK_SH, 1, 1)
+        return True
+
+class fI(Manager):
     idsize = memoryview(bytes(0)).cast('Q').itemsize
     allocsize = mmap.PAGESIZE - idsize
-    def __init__(self, n='fI.d'):
+    _small8 = 1 << 10 # lengths below this many qwords each have their own bin
+    _forward = (1 << (idsize * 8)) - 1 # bytelength marking a forwarded region
+    _arena8 = 1 << 15 # length in qwords of per-thread arenas
+    def __init__(self, n='fI.d', growth=2, reserve=1<<20, preallocate=False, shared=False):
+        # the file grows by at least the factor growth and at least reserve
+        # bytes at a time, so remapping is rare during append-heavy use.
+        # preallocate has the filesystem reserve the grown space up front.
+        # shared coordinates with other processes opening the same file.
         import atexit
         self.n = n
+        self.growth = growth
+        self.reserve = reserve
+        self.preallocate = preallocate
+        self.shared = shared
         self.d = os.open(self.n, os.O_RDWR | os.O_CREAT)
-        y = os.lseek(self.d, 0, os.SEEK_END)
-        os.lseek(self.d, 0, os.SEEK_CUR)
-        if y > 0:
-            # - assert that the structure is correct
-            self.w = memoryview(mmap.mmap(self.d, y))
-            self.q = self.w.cast('Q')
-            y = len(self.w)
+        self.m = None
+        self._arenas = {} # thread: [addr8, l8]
+        self._held = set()
+        self._moves = 0 # compaction passes, odd during one
+        self._moving = Lock() # held during a compaction pass
+        if shared:
+            self._lock = _FileLock(self.n + '.lock', self._sync, self._journal)
+            with self._lock: # exclusive, in case the file is being created
+                pass
+        else:
+            self._lock = Lock()
+            self._sync()
+        atexit.register(self.shrink)
+    def _sync(self, records=None):
+        # map the file at its current size, creating it if empty, and index
+        # it, or apply the records of changes other processes logged
+        y = os.fstat(self.d).st_size
         if y < self.idsize:
-            os.truncate(self.n, mmap.PAGESIZE)
-            self.w = memoryview(mmap.mmap(self.d, mmap.PAGESIZE))
+            os.ftruncate(self.d, mmap.PAGESIZE)
+            self.m = mmap.mmap(self.d, mmap.PAGESIZE)
+            self.w = memoryview(self.m)
             self.q = self.w.cast('Q')
             self.q[0] = 1
             self.q[1] = 0
             self.q[2] = len(self.q) - 1
+        elif self.m is None:
+            # - assert that the structure is correct
+            self.m = mmap.mmap(self.d, y)
+            self.w = memoryview(self.m)
+            self.q = self.w.cast('Q')
+        elif y != len(self.m):
+            self._remap(y)
         self.yq = len(self.q)
-        atexit.register(self.shrink)
-    def dealloc(self, id):
-        self.fsck()
-        addr8 = memoryview(id).cast('Q')[0]
-        l8 = max((self.q[addr8]+self.idsize-1)//self.idsize,1) + 1
-        self.q[addr8] = self.q[0]
+        if records is None:
+            self._index()
+        else:
+            for yq, entries in records:
+                self._replay(yq, entries)
+            self.yq = len(self.q)
+        self._changed = {} # free region -> its length before the change, or 0
+    def _touch(self, addr8):
+        # note a region's entry in the index before it changes, for the log
+        if addr8 not in self._changed:
+            self._changed[addr8] = self.q[addr8+1] if addr8 in self._prev else 0
+    def _journal(self):
+        # the entries of the current change, [addr8, old l8, prev8, l8] each,
+        # with an l8 of 0 for regions no longer free
+        entries = array.array('Q')
+        for addr8, old_l8 in self._changed.items():
+            prev8 = self._prev.get(addr8)
+            if prev8 is None:
+                entries.extend([addr8, old_l8, 0, 0])
+            else:
+                entries.extend([addr8, old_l8, prev8, self.q[addr8+1]])
+        self._changed = {}
+        return self.yq, entries
+    def _replay(self, yq, entries):
+        # apply another process's change, as the file was then yq qwords long.
+        # every old entry is removed before any new one is added, as a new
+        # region may end where an old one did.
+        self.yq = yq
+        for idx in range(0, len(entries), 4):
+            addr8, old_l8 = entries[idx:idx+2]
+            if old_l8:
+                self._detach(addr8, old_l8)
+                del self._prev[addr8]
+        for idx in range(0, len(entries), 4):
+            addr8, old_l8, prev8, l8 = entries[idx:idx+4]
+            if l8:
+                self._prev[addr8] = prev8
+                self._attach(addr8, l8)
+    def _index(self):
+        # rebuild the in-memory free space index from the linked list
+        self._prev = {}
+        self._ends = {}
+        self._bins = [{} for c in range(self._bin(self.yq) + 1)]
+        self._mask = 0
+        self._tail8 = None
+        for addr8, prev8 in self._all_regions(True):
+            self._prev[addr8] = prev8
+            self._attach(addr8)
+        assert self._tail8 is not None
+    def _bin(self, l8):
+        if l8 < self._small8:
+            return l8
+        return self._small8 + l8.bit_length() - self._small8.bit_length()
+    def _fit_bin(self, l8):
+        # the first bin all of whose regions are at least l8 long
+        c = self._bin(l8)
+        if l8 >= self._small8 and l8 & (l8 - 1):
+            c += 1
+        return c
+    def _bin_add(self, addr8, l8):
+        c = self._bin(l8)
+        while c >= len(self._bins):
+            self._bins.append({})
+        self._bins[c][addr8] = None
+        self._mask |= 1 << c
+    def _bin_remove(self, addr8, l8):
+        c = self._bin(l8)
+        bin = self._bins[c]
+        del bin[addr8]
+        if not bin:
+            self._mask &= ~(1 << c)
+    def _attach(self, addr8, l8=None):
+        # index a free region by size and end, or as the tail
+        if l8 is None:
+            l8 = self.q[addr8+1]
+        if addr8 + l8 == self.yq:
+            self._tail8 = addr8
+        else:
+            self._bin_add(addr8, l8)
+            self._ends[addr8 + l8] = addr8
+    def _detach(self, addr8, l8=None):
+        # unindex a free region, before it is resized or removed
+        if l8 is None:
+            if self.shared:
+                self._touch(addr8)
+            l8 = self.q[addr8+1]
+        if addr8 == self._tail8:
+            self._tail8 = None
+        else:
+            self._bin_remove(addr8, l8)
+            del self._ends[addr8 + l8]
+    def _binned(self, l8):
+        # the bin of a free region that is either exactly l8 long or can be
+        # split leaving at least 2 qwords, or None
+        mask = self._mask
+        if l8 < self._small8 and mask >> l8 & 1:
+            return l8
+        c = self._fit_bin(l8 + 2)
+        mask >>= c
+        if mask:
+            return c + (mask & -mask).bit_length() - 1
+        return None
+    def _take_bin(self, l8):
+        c = self._binned(l8)
+        if c is None:
+            return None
+        return next(iter(self._bins[c]))
+    def _take(self, l8):
+        addr8 = self._take_bin(l8)
+        if addr8 is not None:
+            return addr8
+        # no binned regions were found that data fits in. use the tail, expanding it if needed.
+        addr8 = self._tail8
+        if self.q[addr8+1] < l8 + 2: # two extra to ensure there is always an unallocated region to use
+            self._grow(l8)
+        return addr8
+    def _grow(self, l8):
+        addr8 = self._tail8
+        assert self.q[addr8+1] == self.yq - addr8
+        y = self.yq * self.idsize
+        y2 = max(int(y * self.growth), y + self.reserve, (addr8+l8+2)*self.idsize)
+        y2 = (y2 - 1) // mmap.PAGESIZE * mmap.PAGESIZE + mmap.PAGESIZE
+        self._remap(y2)
+        self.q[addr8+1] = self.yq - addr8
+    def _remap(self, y2):
+        # resize the file and its mapping. the mapping is resized in place,
+        # with mremap on linux, unless views from fetch_view still hold it.
+        # then a new mapping is made and the old one stays valid for them,
+        # up to the point the file is shrunk.
+        y = len(self.w)
+        if self.preallocate and y2 > y:
+            try:
+                os.posix_fallocate(self.d, y, y2 - y)
+            except OSError:
+                pass # not supported by the filesystem; resizing still extends the file
+        self.q.release()
+        self.w.release()
+        try:
+            self.m.resize(y2)
+        except BufferError:
+            os.ftruncate(self.d, y2)
+            self.m = mmap.mmap(self.d, y2)
+        self.w = memoryview(self.m)
+        self.q = self.w.cast('Q')
+        self.yq = len(self.q)
+    def _unlink(self, addr8):
+        # remove a free region from the linked list
+        if self.shared:
+            self._touch(addr8)
+        prev8 = self._prev.pop(addr8)
+        next8 = self.q[addr8]
+        self.q[prev8] = next8
+        if next8:
+            if self.shared:
+                self._touch(next8)
+            self._prev[next8] = prev8
+    def _push(self, addr8, l8):
+        # add a free region to the head of the linked list
+        next8 = self.q[0]
+        if self.shared:
+            self._touch(addr8)
+            if next8:
+                self._touch(next8)
+        self.q[addr8] = next8
         self.q[addr8+1] = l8
         self.q[0] = addr8
-        self.fsck()
+        self._prev[addr8] = 0
+        if next8:
+            self._prev[next8] = addr8
+    def _alloc_l8(self, addr8):
+        # the length in qwords of an allocated or forwarded region
+        l = self.q[addr8]
+        if l == self._forward:
+            return 2
+        return max((l+self.idsize-1)//self.idsize,1) + 1
+    def _resolve8(self, id, q):
+        # the address and bytelength an id's data is at, each length read
+        # once so that a forward being written is either seen whole or not
+        addr8 = memoryview(id).cast('Q')[0]
+        l = q[addr8]
+        while l == self._forward:
+            addr8 = q[addr8+1]
+            l = q[addr8]
+        return addr8, l
+    def _moved(self, moves):
+        # whether compaction may have moved regions since moves was noted,
+        # after waiting for any pass in progress to end
+        if self._moves == moves and not moves & 1:
+            return False
+        with self._moving:
+            pass
+        return True
+    def dealloc(self, id):
+        # frees the region and any forwarded regions left for the id
+        with self._lock:
+            addr8 = memoryview(id).cast('Q')[0]
+            while self.q[addr8] == self._forward:
+                next8 = self.q[addr8+1]
+                self._free(addr8, 2)
+                addr8 = next8
+            self._free(addr8, self._alloc_l8(addr8))
+    def _free(self, addr8, l8):
+        next8 = addr8 + l8
+        if next8 in self._prev and next8 not in self._held:
+            # merge with the following free region
+            self._detach(next8)
+            self._unlink(next8)
+            l8 += self.q[next8+1]
+        prev8 = self._ends.get(addr8)
+        if prev8 is not None:
+            # merge into the preceding free region, which keeps its place in the list
+            self._detach(prev8)
+            addr8 = prev8
+            l8 += self.q[addr8+1]
+            self.q[addr8+1] = l8
+        else:
+            self._push(addr8, l8)
+        self._attach(addr8)
     def alloc(self, data, replacing=[]):
-        self.fsck()
         l8 = max((len(data)+self.idsize-1)//self.idsize,1) + 1
-        for addr8, _l8, prev8, next8 in self._all_regions(True,True,True):
-            if (_l8 == l8 and next8 != 0) or _l8 >= l8+2:
-                    # why does next need to be nonzero to use an exactly matching thing ...?
-                # found region
-                break
+        if not self.shared and l8 <= self._arena8 >> 4 and self._binned(l8) is None:
+            # freed space is reused first. arenas replace growing into the tail.
+            addr8 = self._arena_take(l8)
         else:
-            # no regions were found that data fits in. expand the last one and use it.
-            assert self.q[addr8+1] == self.yq - addr8
-            y2 = self.yq *2*self.idsize
-            if (addr8+l8+2)*self.idsize > y2: # two extra to ensure there is always an unallocated region to use
-                y2 = ((addr8+(l8+2)*2-1)*self.idsize // mmap.PAGESIZE + 1) * mmap.PAGESIZE
-            os.truncate(self.n, y2)
-            self.w = memoryview(mmap.mmap(self.d, y2))
-            self.q = self.w.cast('Q')
-            self.yq = len(self.q)
-            self.q[addr8+1] = self.yq - addr8
-            self.fsck()
+            with self._lock:
+                addr8 = self._take(l8)
+                self._carve(addr8, l8)
+                # keep the region well formed for other processes walking the file
+                self.q[addr8] = len(data)
         # set id from its address
-        id = self.q[prev8:prev8+1].tobytes()
-        # remove region from linked list
-        if self.q[addr8+1] > l8:
-            assert prev8 != 0 or addr8 + l8 != 0
-            assert self.q[addr8+1] >= l8 + 2
-            self.q[prev8] = addr8 + l8
-            self.q[addr8+l8] = self.q[addr8]
-            self.q[addr8+l8+1] = self.q[addr8+1] - l8
-        else:
-            assert prev8 != 0 or self.q[addr8] != 0
-            self.q[prev8] = self.q[addr8]
+        id = addr8.to_bytes(self.idsize, sys.byteorder)
         addr0 = addr8 * self.idsize
         addr1 = addr0 + self.idsize
-        self.q[addr8] = len(data)
-        self.w[addr1:addr1+len(data)] = data
+        with memoryview(self.m) as w, w.cast('Q') as q:
+            q[addr8] = len(data)
+            w[addr1:addr1+len(data)] = data
         #for replaced in replacing:
         #    self._dealloc(replaced)
         assert self.fetch(id) == data
-        self.fsck()
         return id
-    def fetch(self, id):
-        addr8 = memoryview(id).cast('Q')[0]
-        l = self.q[addr8]
+    def alloc_many(self, datas, replacing=[]):
+        # places a batch under one lock, growing the tail at most once for it
+        datas = list(datas)
+        if len(datas) <= 1:
+            return [self.alloc(data, replacing=replacing) for data in datas]
+        l8s = [max((len(data)+self.idsize-1)//self.idsize,1) + 1 for data in datas]
+        with self._lock:
+            total8 = sum(l8s)
+            if self._binned(total8) is None and self.q[self._tail8+1] < total8 + 2:
+                self._grow(total8)
+            addr8s = []
+            for data, l8 in zip(datas, l8s):
+                addr8 = self._take(l8)
+                self._carve(addr8, l8)
+                self.q[addr8] = len(data)
+                addr8s.append(addr8)
+        ids = []
+        with memoryview(self.m) as w:
+            for data, addr8 in zip(datas, addr8s):
+                addr1 = (addr8 + 1) * self.idsize
+                w[addr1:addr1+len(data)] = data
+                ids.append(addr8.to_bytes(self.idsize, sys.byteorder))
+        assert self.fetch_many(ids) == [bytes(data) for data in datas]
+        return ids
+    def _arena_take(self, l8):
+        # carve l8 qwords from the back of this thread's arena
+        th = current_thread()
+        arena = self._arenas.get(th)
+        if arena is None or arena[1] < l8 + 2:
+            with self._lock:
+                for _th in [_th for _th in self._arenas if not _th.is_alive()]:
+                    self._release(self._arenas.pop(_th))
+                if arena is not None:
+                    self._release(arena)
+                arena = self._arena_new()
+                self._arenas[th] = arena
+        arena[1] -= l8
+        with memoryview(self.m) as w, w.cast('Q') as q:
+            q[arena[0]+1] = arena[1]
+        return arena[0] + arena[1]
+    def _arena_new(self):
+        addr8 = self._take(self._arena8)
+        l8 = self.q[addr8+1]
+        self._detach(addr8)
+        if l8 > self._arena8:
+            # the excess becomes a free region following the arena in the list
+            rest8 = addr8 + self._arena8
+            next8 = self.q[addr8]
+            self.q[rest8] = next8
+            self.q[rest8+1] = l8 - self._arena8
+            self.q[addr8] = rest8
+            self.q[addr8+1] = self._arena8
+            self._prev[rest8] = addr8
+            if next8:
+                self._prev[next8] = rest8
+            self._attach(rest8)
+        self._held.add(addr8)
+        return [addr8, self.q[addr8+1]]
+    def _release(self, arena):
+        # return an arena's remaining space, merging it with its neighbours
+        addr8, l8 = arena
+        self._held.remove(addr8)
+        self._unlink(addr8)
+        self._free(addr8, l8)
+    def _reclaim(self):
+        while self._arenas:
+            self._release(self._arenas.popitem()[1])
+    def _carve(self, addr8, l8):
+        # remove region from linked list, leaving any excess free
+        _l8 = self.q[addr8+1]
+        self._detach(addr8)
+        if _l8 > l8:
+            assert _l8 >= l8 + 2
+            prev8 = self._prev.pop(addr8)
+            next8 = self.q[addr8]
+            if self.shared:
+                self._touch(addr8 + l8)
+                if next8:
+                    self._touch(next8)
+            self.q[prev8] = addr8 + l8
+            self.q[addr8+l8] = next8
+            self.q[addr8+l8+1] = _l8 - l8
+            self._prev[addr8+l8] = prev8
+            if next8:
+                self._prev[next8] = addr8 + l8
+            self._attach(addr8 + l8)
+        else:
+            assert self._tail8 is not None
+            self._unlink(addr8)
+    def _locate(self, id):
+        # a view of the mapping, and the offset and length of an id's data
+        w = memoryview(self.m)
+        with w.cast('Q') as q:
+            try:
+                addr8, l = self._resolve8(id, q)
+            except IndexError:
+                addr8 = l = len(q)
         addr = (addr8+1) * self.idsize
-        return self.w[addr:addr+l].tobytes()
+        if addr + l > len(w):
+            w.release()
+            if self.shared:
+                # another process may have grown the file
+                y = len(self.m)
+                self._lock.refresh()
+                if len(self.m) != y:
+                    return self._locate(id)
+            raise IndexError('id out of range')
+        return [w, addr, l]
+    def _locate_many(self, ids):
+        # a view of the mapping and the offsets and lengths of many ids' data,
+        # or None if any lie past it
+        w = memoryview(self.m)
+        spans = []
+        with w.cast('Q') as q:
+            try:
+                for id in ids:
+                    addr8, l = self._resolve8(id, q)
+                    addr = (addr8+1) * self.idsize
+                    if addr + l > len(w):
+                        raise IndexError('id out of range')
+                    spans.append([addr, l])
+            except IndexError:
+                spans = None
+        if spans is None:
+            w.release()
+            return None
+        return [w, spans]
+    def fetch(self, id):
+        moves = self._moves
+        w, addr, l = self._locate(id)
+        with w:
+            data = w[addr:addr+l].tobytes()
+        if self._moved(moves):
+            return self.fetch(id)
+        return data
+    def fetch_range(self, id, start, stop):
+        moves = self._moves
+        w, addr, l = self._locate(id)
+        begin, end, step = slice(start, stop).indices(l)
+        with w:
+            data = w[addr+begin:addr+max(begin,end)].tobytes()
+        if self._moved(moves):
+            return self.fetch_range(id, start, stop)
+        return data
+    def fetch_view(self, id):
+        # a read-only view into the mapping, without copying.
+        # it is only meaningful until the id is deallocated or compacted.
+        w, addr, l = self._locate(id)
+        return w[addr:addr+l].toreadonly()
     def fetch_size(self, id):
-        addr8 = memoryview(id).cast('Q')[0]
-        return self.q[addr8]
+        w, addr, l = self._locate(id)
+        w.release()
+        return l
+    def fetch_many(self, ids):
+        ids = list(ids)
+        moves = self._moves
+        located = self._locate_many(ids)
+        if located is None:
+            # one at a time, refreshing the mapping as needed
+            return super().fetch_many(ids)
+        w, spans = located
+        with w:
+            datas = [w[addr:addr+l].tobytes() for addr, l in spans]
+        if self._moved(moves):
+            return self.fetch_many(ids)
+        return datas
+    def fetch_view_many(self, ids):
+        ids = list(ids)
+        located = self._locate_many(ids)
+        if located is None:
+            return [self.fetch_view(id) for id in ids]
+        w, spans = located
+        return [w[addr:addr+l].toreadonly() for addr, l in spans]
+    def fetch_size_many(self, ids):
+        ids = list(ids)
+        located = self._locate_many(ids)
+        if located is None:
+            return super().fetch_size_many(ids)
+        w, spans = located
+        w.release()
+        return [l for addr, l in spans]
+    def resolve(self, id):
+        # the current id of data that may have been moved by compact
+        with memoryview(self.m) as w, w.cast('Q') as q:
+            return self._resolve8(id, q)[0].to_bytes(self.idsize, sys.byteorder)
+    def retire(self, id):
+        # like resolve, but also frees the forwarded regions left for the id.
+        # the old id must no longer be used after this.
+        with self._lock:
+            addr8 = memoryview(id).cast('Q')[0]
+            while self.q[addr8] == self._forward:
+                next8 = self.q[addr8+1]
+                self._free(addr8, 2)
+                addr8 = next8
+        return addr8.to_bytes(self.idsize, sys.byteorder)
+    def compact(self, limit=None):
+        # move allocated regions from the end of the file into free space
+        # nearer the front, leaving forwarded regions at their old places.
+        # the file can only shrink past them once they are retired, which
+        # the rewrite() methods of documents, arrays and dicts do.
+        # returns the number of regions moved, none if other processes
+        # have the store open.
+        with self._lock:
+            self._reclaim()
+            if self.shared and not self._lock.alone():
+                return 0
+            with self._moving:
+                self._moves += 1
+                try:
+                    return self._compact(limit)
+                finally:
+                    self._moves += 1
+    def _compact(self, limit):
+        regions = [
+            [addr8, l8]
+            for addr8, l8, free in self._walk()
+            if not free and l8 >= 4 and self.q[addr8] != self._forward
+        ]
+        moved = 0
+        for addr8, l8 in reversed(regions):
+            if moved == limit:
+                break
+            dest8 = self._take_bin(l8)
+            if dest8 is None or dest8 > addr8:
+                continue
+            self._carve(dest8, l8)
+            self.w[dest8*self.idsize:(dest8+l8)*self.idsize] = self.w[addr8*self.idsize:(addr8+l8)*self.idsize]
+            # the new address goes first, so a forward is never seen without it
+            self.q[addr8+1] = dest8
+            self.q[addr8] = self._forward
+            self._free(addr8+2, l8-2)
+            moved += 1
+        return moved
+    def _walk(self):
+        # yield [addr8, l8, free] for every region in address order
+        addr8 = 1
+        while addr8 < self.yq:
+            if addr8 in self._prev:
+                l8 = self.q[addr8+1]
+                yield [addr8, l8, True]
+            else:
+                l8 = self._alloc_l8(addr8)
+                yield [addr8, l8, False]
+            addr8 += l8
+    def ids(self):
+        # the ids of all allocated data, in address order
+        with self._lock:
+            self._reclaim()
+            return [
+                addr8.to_bytes(self.idsize, sys.byteorder)
+                for addr8, l8, free in self._walk()
+                if not free and self.q[addr8] != self._forward
+            ]
     def fsck(self):
         regions = list(self._all_regions(include_l8=True)) # [[addr8, l8],...]
         regions.sort(reverse=True)
@@ -110,10 +709,24 @@ class fI:
                 assert region[1] <= self.yq - addr8
                 addr8 += region[1]
             else:
-                l8 = max((self.q[addr8]+self.idsize-1)//self.idsize,1) + 1
+                l8 = self._alloc_l8(addr8)
                 assert l8 <= self.yq - addr8
                 addr8 += l8
         assert addr8 == self.yq
+        # check the in-memory index against the linked list
+        assert len(passed_regions) == len(self._prev)
+        for addr8, l8 in passed_regions:
+            prev8 = self._prev[addr8]
+            assert self.q[prev8] == addr8
+            if addr8 == self._tail8:
+                assert addr8 + l8 == self.yq
+            elif addr8 in self._held:
+                assert [addr8, l8] in self._arenas.values()
+            else:
+                assert addr8 in self._bins[self._bin(l8)]
+                assert self._ends[addr8 + l8] == addr8
+        assert sum(map(len, self._bins)) == len(self._prev) - 1 - len(self._held)
+        assert len(self._ends) == len(self._prev) - 1 - len(self._held)
     def _all_regions(self, add_prev=False, include_l8=False, add_next=False):
         prev8 = 0; addr8 = self.q[prev8]
         seen_regions = set()
@@ -139,65 +752,192 @@ class fI:
             yield item
             prev8, addr8 = [addr8, next8]
     def shrink(self):
-        #import pdb; pdb.set_trace()
-        self.fsck()
-        unused = self._calc_unused()
+        with self._lock:
+            self._reclaim()
+            # truncating under other processes would leave their mappings past the end
+            self._shrink(not self.shared or self._lock.alone())
+    def _shrink(self, truncate=True):
+        # merge any neighbouring free regions, as files written before
+        # dealloc coalesced may contain them. each region is absorbed once.
+        for addr8 in list(self._prev):
+            if addr8 not in self._prev:
+                continue
+            next8 = addr8 + self.q[addr8+1]
+            if next8 in self._prev:
+                self._detach(addr8)
+                while next8 in self._prev:
+                    self._detach(next8)
+                    self._unlink(next8)
+                    self.q[addr8+1] += self.q[next8+1]
+                    next8 = addr8 + self.q[addr8+1]
+                self._attach(addr8)
 
-        # merge regions
-
-        #dbg_passed_regions = []
-        # quick inefficent solution to iterating unallocated regions while they are changing
-        regions = list(self._all_regions(True))
-        regions.sort(reverse=True)
-        while len(regions) > 1:
-            self.fsck()
-            [head0, prev0], [head1, prev1] = [regions.pop(), regions[-1]]
-            #dbg_passed_regions.append(prev0)
-            tail0 = self.q[head0+1] + head0
-            tail1 = self.q[head1+1] + head1
-            assert head0 != head1
-            self.fsck()
-            if tail0 == head1:
-                # remove region0
-                assert self._calc_unused() == unused
-                if prev1 == head0:
-                    assert head1 != prev0
-                    self.q[prev0] = head1
-                    prev1 = prev0
-                else:
-                    assert self.q[head0] != prev0
-                    self.q[prev0] = self.q[head0]
-                assert self._calc_unused() == unused - (tail0 - head0)
-
-                assert self.q[head1] != head0
-                self.q[head0] = self.q[head1] # set region0's next to region1's next
-                self.q[head0+1] = tail1 - head0 # set region0's length to region0's + region1's
-                assert head0 != prev1
-                self.q[prev1] = head0 # <- reseat region1 to be region0 + region1
-                #regions[idx][0] = head0 # <-
-                assert self._calc_unused() == unused
-                self.fsck()
-                # quick inefficent solution to iterating unallocated regions while they are changing
-                regions = list(self._all_regions(True))
-                regions.sort(reverse=True)
-            else:
-                assert tail0 < head1
-            assert self._calc_unused() == unused
         # remove tail region
-        self.fsck()
-        #regions.sort()
-        addr8, prev8 = regions[0]
-        unused += 2 - self.q[addr8+1]
-        y2 = (addr8+2)*self.idsize
-        os.truncate(self.n, y2)
-        self.w = memoryview(mmap.mmap(self.d, y2))
-        self.q = self.w.cast('Q')
-        self.yq = len(self.q)
-        self.q[addr8+1] = self.yq - addr8
-        assert self.q[addr8+1] == 2
-        self.fsck()
+        if truncate:
+            addr8 = self._tail8
+            y2 = (addr8+2)*self.idsize
+            self._remap(y2)
+            self.q[addr8+1] = self.yq - addr8
+            assert self.q[addr8+1] == 2
+        unused = self._calc_unused()
         print('used:  ', (self.yq - unused) * self.idsize)
         print('unused:', unused * self.idsize)
         print('total: ', self.yq * self.idsize)
     def _calc_unused(self):
         return sum([self.q[addr8+1] for addr8 in self._all_regions()])
+
+if __name__ == '__main__':
+    # alloc latency as fragmentation grows.
+    # each round allocates a batch, then frees every other region of it,
+    # so the number of free regions rises steadily.
+    import random, tempfile, time
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = fI(os.path.join(tmp, 'fI.d'))
+        ids = []
+        print('free regions', 'alloc us', sep='\t')
+        for iteration in range(16):
+            datas = [bytes(random.randint(1, fI.allocsize)) for x in range(2048)]
+            t0 = time.perf_counter()
+            batch = [store.alloc(data) for data in datas]
+            t1 = time.perf_counter()
+            ids.extend(batch[1::2])
+            for id in batch[::2]:
+                store.dealloc(id)
+            print(len(store._prev), round((t1 - t0) / len(datas) * 1000000, 2), sep='\t')
+        store.fsck()
+        store.shrink()
+        total = store.yq * store.idsize
+        moved = store.compact()
+        ids = [store.retire(id) for id in ids]
+        store.shrink()
+        store.fsck()
+        print('compacted', moved, 'bytes', total, '->', store.yq * store.idsize, sep='\t')
+        t0 = time.perf_counter()
+        for id in ids:
+            store.dealloc(id)
+        t1 = time.perf_counter()
+        assert len(store._prev) == 1
+        store.shrink()
+        t2 = time.perf_counter()
+        print('dealloc all us', round((t1 - t0) / len(ids) * 1000000, 2), sep='\t')
+        print('shrink ms', round((t2 - t1) * 1000, 2), sep='\t')
+        store.fsck()
+
+    # threads allocating and freeing against one store
+    from threading import Thread
+    with tempfile.TemporaryDirectory() as tmp:
+        print('threads', 'kops/s', sep='\t')
+        for nthreads in [1, 2, 4, 8]:
+            store = fI(os.path.join(tmp, f'fI.{nthreads}.d'))
+            failures = []
+            def worker(seed):
+                rng = random.Random(seed)
+                live = []
+                try:
+                    for x in range(4096):
+                        if live and rng.random() < 0.4:
+                            idx = rng.randrange(len(live))
+                            live[idx], live[-1] = live[-1], live[idx]
+                            id, data = live.pop()
+                            assert store.fetch(id) == data
+                            store.dealloc(id)
+                        else:
+                            data = rng.randbytes(rng.randint(0, fI.allocsize))
+                            live.append([store.alloc(data), data])
+                    for id, data in live:
+                        assert store.fetch(id) == data
+                except BaseException as exception:
+                    failures.append(exception)
+            threads = [Thread(target=worker, args=[seed]) for seed in range(nthreads)]
+            t0 = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            t1 = time.perf_counter()
+            assert not failures, failures
+            store.shrink()
+            store.fsck()
+            print(nthreads, round(nthreads * 4096 / (t1 - t0) / 1000, 1), sep='\t')
+        # reads alongside compaction see the data wherever it is moved
+        store = fI(os.path.join(tmp, 'fI.compact.d'))
+        items = [[store.alloc(data), data] for data in [random.randbytes(random.randint(16, 2048)) for x in range(4096)]]
+        for id, data in items[::2]:
+            store.dealloc(id)
+        items = items[1::2]
+        failures = []
+        done = False
+        def reader(seed):
+            rng = random.Random(seed)
+            try:
+                while not done:
+                    batch = rng.sample(items, 8)
+                    assert store.fetch(batch[0][0]) == batch[0][1]
+                    assert store.fetch_range(batch[1][0], 3, 40) == batch[1][1][3:40]
+                    assert store.fetch_many([id for id, data in batch]) == [data for id, data in batch]
+            except BaseException as exception:
+                failures.append(exception)
+        threads = [Thread(target=reader, args=[seed]) for seed in range(2)]
+        for thread in threads:
+            thread.start()
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        moved = store.compact()
+        sys.setswitchinterval(interval)
+        done = True
+        for thread in threads:
+            thread.join()
+        assert not failures, failures
+        store.shrink()
+        store.fsck()
+        print('compacted under reads', moved, sep='\t')
+
+    # processes sharing one store: writers allocate and free, keeping some
+    # regions that a reader process then fetches
+    import multiprocessing
+    with tempfile.TemporaryDirectory() as tmp:
+        n = os.path.join(tmp, 'fI.shared.d')
+        def writer(seed, queue):
+            store = fI(n, shared=True)
+            rng = random.Random(seed)
+            live = []
+            for x in range(1024):
+                if live and rng.random() < 0.4:
+                    id, data = live.pop(rng.randrange(len(live)))
+                    assert store.fetch(id) == data
+                    store.dealloc(id)
+                else:
+                    data = rng.randbytes(rng.randint(0, fI.allocsize * 2))
+                    live.append([store.alloc(data), data])
+                    if rng.random() < 0.1:
+                        queue.put(live.pop())
+            for id, data in live:
+                assert store.fetch(id) == data
+            # the index kept from the log matches one built from the list
+            with store._lock:
+                index = [dict(store._prev), dict(store._ends), store._tail8]
+                store._index()
+                assert index == [dict(store._prev), dict(store._ends), store._tail8]
+            queue.put(None)
+        def reader(nwriters, queue):
+            store = fI(n, shared=True)
+            while nwriters:
+                item = queue.get()
+                if item is None:
+                    nwriters -= 1
+                else:
+                    id, data = item
+                    assert store.fetch(id) == data
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=writer, args=[seed, queue]) for seed in range(4)]
+        processes.append(multiprocessing.Process(target=reader, args=[4, queue]))
+        t0 = time.perf_counter()
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        t1 = time.perf_counter()
+        assert [process.exitcode for process in processes] == [0] * len(processes)
+        fI(n, shared=True).fsck()
+        print('processes', len(processes), 'ms', round((t1 - t0) * 1000, 2), sep='\t')
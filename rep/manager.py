@@ -0,0 +1,81 @@
+import time
+
+class Manager:
+    # the batch side of the manager interface, done one id at a time.
+    # managers override these where many ids can be handled at once.
+    def alloc_many(self, datas, replacing=[]):
+        return [self.alloc(data, replacing=replacing) for data in datas]
+    def fetch_many(self, ids):
+        return [self.fetch(id) for id in ids]
+    def fetch_size_many(self, ids):
+        return [self.fetch_size(id) for id in ids]
+    def fetch_range(self, id, start, stop):
+        return self.fetch(id)[start:stop]
+    def fetch_range_many(self, ids, start, stop):
+        return [self.fetch_range(id, start, stop) for id in ids]
+    def fetch_view(self, id):
+        return memoryview(self.fetch(id))
+    def fetch_view_many(self, ids):
+        return [memoryview(data) for data in self.fetch_many(ids)]
+
+class Batched(Manager):
+    # gives a manager that only handles single ids the batch interface
+    def __init__(self, manager):
+        self.manager = manager
+    def __getattr__(self, name):
+        return getattr(self.manager, name)
+
+class Wrapper(Manager):
+    # a manager in front of another. everything, batch and range calls
+    # included, passes through to the manager behind unless overridden.
+    def __init__(self, manager):
+        if not isinstance(manager, Manager):
+            manager = Batched(manager)
+        self.manager = manager
+        self.idsize = manager.idsize
+        self.allocsize = manager.allocsize
+    def __getattr__(self, name):
+        return getattr(self.manager, name)
+    def alloc(self, data, replacing=[]):
+        return self.manager.alloc(data, replacing=replacing)
+    def alloc_many(self, datas, replacing=[]):
+        return self.manager.alloc_many(datas, replacing=replacing)
+    def dealloc(self, id):
+        self.manager.dealloc(id)
+    def fetch(self, id):
+        return self.manager.fetch(id)
+    def fetch_many(self, ids):
+        return self.manager.fetch_many(ids)
+    def fetch_size(self, id):
+        return self.manager.fetch_size(id)
+    def fetch_size_many(self, ids):
+        return self.manager.fetch_size_many(ids)
+    def fetch_range(self, id, start, stop):
+        return self.manager.fetch_range(id, start, stop)
+    def fetch_range_many(self, ids, start, stop):
+        return self.manager.fetch_range_many(ids, start, stop)
+    def fetch_view(self, id):
+        return self.manager.fetch_view(id)
+    def fetch_view_many(self, ids):
+        return self.manager.fetch_view_many(ids)
+
+class Slow(Wrapper):
+    # a stand-in for a remote manager, for trying things out: each fetch
+    # waits delay seconds and is counted, one id at a time
+    fetch_many = Manager.fetch_many
+    fetch_size_many = Manager.fetch_size_many
+    fetch_range = Manager.fetch_range
+    fetch_range_many = Manager.fetch_range_many
+    fetch_view = Manager.fetch_view
+    fetch_view_many = Manager.fetch_view_many
+    def __init__(self, manager, delay=0.0005):
+        super().__init__(manager)
+        self.delay = delay
+        self.fetches = 0
+    def fetch(self, id):
+        self.fetches += 1
+        time.sleep(self.delay)
+        return self.manager.fetch(id)
+    def fetch_size(self, id):
+        time.sleep(self.delay)
+        return self.manager.fetch_size(id)
@@ -1,10 +1,126 @@
 from base64 import _urlsafe_encode_translation
 from binascii import b2a_base64
-from threading import current_thread
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Condition, Lock, current_thread
+import os, time
 import requests
 
-class aR:
-    def __init__(self, *params, **kwparams):
+from .manager import Manager
+
+class Gateways:
+    # spreads requests over a set of gateways. each request goes to the
+    # gateway with the best record, is hedged on the next one if it runs
+    # slower than that gateway usually does, and fails over when it errors.
+    def __init__(self, urls, concurrency=16, hedge=3, hedge_after=1, timeout=30):
+        self.urls = list(urls)
+        self.hedge = hedge # multiple of a gateway's usual latency to wait before hedging
+        self.hedge_after = hedge_after # seconds to wait on gateways with no record
+        self.timeout = timeout
+        self.latency = { url: None for url in self.urls } # moving average, seconds
+        self.failures = { url: 0 for url in self.urls } # consecutive
+        self.hedged = 0
+        self.failed_over = 0
+        self._lock = Lock()
+        self._sessions = {}
+        # the pool bounds the number of open connections
+        self._pool = ThreadPoolExecutor(concurrency)
+    def _session(self):
+        # sessions are not shared across threads
+        th = current_thread()
+        session = self._sessions.get(th)
+        if session is None:
+            session = requests.Session()
+            self._sessions[th] = session
+        return session
+    def _ranked(self):
+        # gateways with no record go first so every gateway gets measured.
+        # each consecutive failure doubles the weight of a gateway's latency.
+        with self._lock:
+            return sorted(self.urls, key=lambda url:
+                (self.latency[url] or 0) * (1 << min(self.failures[url], 16))
+                + self.failures[url] * self.timeout)
+    def _delay(self, url):
+        latency = self.latency[url]
+        if latency is None:
+            return self.hedge_after
+        return latency * self.hedge
+    def _attempt(self, method, url, path, headers):
+        start = time.perf_counter()
+        try:
+            response = self._session().request(method, url + path, headers=headers, timeout=self.timeout)
+            response.raise_for_status()
+        except Exception:
+            with self._lock:
+                self.failures[url] += 1
+            raise
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.failures[url] = 0
+            average = self.latency[url]
+            self.latency[url] = latency if average is None else average * 0.75 + latency * 0.25
+        return response
+    def request(self, method, path, headers=None):
+        gateways = iter(self._ranked())
+        pending = {}
+        errors = []
+        def launch():
+            url = next(gateways, None)
+            if url is not None:
+                pending[self._pool.submit(self._attempt, method, url, path, headers)] = url
+            return url is not None
+        launch()
+        while pending:
+            delay = min([self._delay(url) for url in pending.values()])
+            done, _ = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                if launch():
+                    self.hedged += 1
+                else:
+                    wait(pending, return_when=FIRST_COMPLETED)
+                continue
+            for future in done:
+                del pending[future]
+                try:
+                    response = future.result()
+                except Exception as error:
+                    errors.append(error)
+                    continue
+                for future in pending:
+                    future.cancel()
+                return response
+            if launch():
+                self.failed_over += 1
+        raise errors[-1]
+    def get(self, path, headers=None):
+        return self.request('GET', path, headers)
+    def head(self, path):
+        return self.request('HEAD', path)
+
+_signer = None
+def _signer_start(make, *params):
+    global _signer
+    _signer = make(*params)
+def _sign(data):
+    return _signer.header(data)
+def _ditem_signer(params, kwparams):
+    from ar import Wallet as T, DataItem as M
+    from toys.accelerated_ditem_signing import AcceleratedSigner as D
+    return D(M(data=b'', *params, **kwparams), T('aR.w').rsa)
+
+class Signers:
+    # signs chunks in a pool of processes, so signing is not held to one
+    # core. each process makes its signer once, with make(*params).
+    def __init__(self, make, *params, processes=None):
+        self.processes = processes or os.cpu_count()
+        self._pool = ProcessPoolExecutor(self.processes, initializer=_signer_start, initargs=(make,)+params)
+    def headers(self, datas):
+        # the headers of datas, in order
+        datas = list(datas)
+        chunksize = max(1, len(datas) // (self.processes * 4))
+        return list(self._pool.map(_sign, datas, chunksize=chunksize))
+
+class aR(Manager):
+    def __init__(self, *params, concurrency=8, write_behind=False, pending_bytes=1<<26, retries=5, signers=0, **kwparams):
         from ar import Peer as R, Wallet as T, DataItem as M, PUBLIC_GATEWAYS as C
         from bundlr.node import DEFAULT_API_URL as L, DEFAULT_SUBSIDY_MAX_BYTES as S, Node as E
         from toys.accelerated_ditem_signing import AcceleratedSigner as D, AR_DIGEST as _
@@ -13,7 +129,12 @@ class aR:
         self._e = E()
         #self._r = R()
         self._c = C
-        self.__ = requests.Session()
+        # hedged requests need room beyond the batches waiting on them
+        self._g = Gateways(C, concurrency=concurrency*2)
+        # workers start when the first batch is submitted
+        self._pool = ThreadPoolExecutor(concurrency)
+
+        self._start_uploads(concurrency, write_behind, pending_bytes, retries)
 
         try:
             t = T('aR.w')
@@ -22,6 +143,8 @@ class aR:
         _d = D(M(data=b'', *params, **kwparams), t.rsa)
         self._d = _d
         self._ds = { current_thread(): _d }
+        # with signers, batches are signed by that many processes
+        self._signers = Signers(_ditem_signer, params, kwparams, processes=signers) if signers else None
 
         s0, s1 = _d.signature_range()
         def id(data):
@@ -34,6 +157,22 @@ class aR:
         self.allocsize = S - len(_dh)
         self.idsize = len(id(_dh))
 
+    def _start_uploads(self, concurrency, write_behind, pending_bytes, retries):
+        # with write_behind, alloc returns once its upload is queued.
+        # queued uploads are served from memory until they are sent.
+        # uploads that run out of retries are kept, and still served, until
+        # retry queues them again. their errors are raised once each.
+        self.write_behind = write_behind
+        self.pending_bytes = pending_bytes # alloc waits while more than this is queued
+        self.retries = retries
+        self.backoff = 0.5 # seconds before the first retry, doubling after
+        self._pending = {} # id -> [encoded, header length]
+        self._pending_size = 0
+        self._failed = {} # id -> [encoded, header length]
+        self._errors = []
+        self._sent = Condition()
+        self._uploads = ThreadPoolExecutor(concurrency)
+
     def dealloc(self, id):
         pass
 
@@ -45,15 +184,281 @@ class aR:
             _d = self._d.clone()
             _ds[th] = _d
         encoded = _d.header(data) + data
-        res = self._e.send_tx(encoded)
-        return self._id(encoded)
+        return self._send(encoded, len(data))
+
+    def _send(self, encoded, length):
+        id = self._id(encoded)
+        if not self.write_behind:
+            res = self._e.send_tx(encoded)
+            return id
+        with self._sent:
+            while self._pending and self._pending_size + len(encoded) > self.pending_bytes:
+                self._raise()
+                self._sent.wait()
+            self._raise()
+            if id not in self._pending:
+                self._failed.pop(id, None)
+                self._queue(id, encoded, len(encoded) - length)
+        return id
+
+    def _queue(self, id, encoded, header_length):
+        # with self._sent held
+        self._pending[id] = [encoded, header_length]
+        self._pending_size += len(encoded)
+        self._uploads.submit(self._upload, id, encoded)
+
+    def _upload(self, id, encoded):
+        for attempt in range(self.retries + 1):
+            try:
+                res = self._e.send_tx(encoded)
+                break
+            except Exception as error:
+                if attempt == self.retries:
+                    with self._sent:
+                        # the data is kept so it can still be read and retried
+                        self._failed[id] = self._pending.pop(id)
+                        self._pending_size -= len(encoded)
+                        self._errors.append(error)
+                        self._sent.notify_all()
+                    return
+                time.sleep(min(self.backoff * (1 << attempt), 30))
+        with self._sent:
+            del self._pending[id]
+            self._pending_size -= len(encoded)
+            self._sent.notify_all()
+
+    def _raise(self):
+        # raises the oldest upload error not yet raised, keeping the rest
+        if self._errors:
+            raise self._errors.pop(0)
+
+    def retry(self):
+        # queues the uploads that ran out of retries again, returning how many
+        with self._sent:
+            failed = self._failed
+            self._failed = {}
+            self._errors = []
+            for id, [encoded, header_length] in failed.items():
+                self._queue(id, encoded, header_length)
+        return len(failed)
+
+    def flush(self):
+        # waits for queued uploads to be sent
+        with self._sent:
+            while self._pending:
+                self._raise()
+                self._sent.wait()
+            self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def _map(self, func, items):
+        items = list(items)
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        return list(self._pool.map(func, items))
+
+    def alloc_many(self, datas, replacing=[]):
+        datas = list(datas)
+        if self._signers is None or len(datas) <= 1:
+            return self._map(lambda data: self.alloc(data, replacing=replacing), datas)
+        headers = self._signers.headers(datas)
+        return self._map(lambda header_data: self._send(header_data[0] + header_data[1], len(header_data[1])), zip(headers, datas))
+
+    def fetch_many(self, ids):
+        return self._map(self.fetch, ids)
+
+    def fetch_size_many(self, ids):
+        return self._map(self.fetch_size, ids)
+
+    def fetch_range_many(self, ids, start, stop):
+        return self._map(lambda id: self.fetch_range(id, start, stop), ids)
+
+    def _queued(self, id):
+        # [encoded, header length] for data not yet sent, else None
+        pending = self._pending.get(id)
+        if pending is None:
+            pending = self._failed.get(id)
+        return pending
 
     def fetch(self, id):
+        pending = self._queued(id)
+        if pending is not None:
+            encoded, off = pending
+            return encoded[off:]
         id_str = b2a_base64(id, newline=False).rstrip(b'=').translate(_urlsafe_encode_translation)
-        return self.__.get(self._c[0] + '/raw/' + id_str.decode()).content
+        return self._g.get('/raw/' + id_str.decode()).content
         #return self._r._request('raw', id_str.decode(), method='GET').content
 
+    def fetch_range(self, id, start, stop):
+        pending = self._queued(id)
+        if pending is not None:
+            encoded, off = pending
+            return encoded[off:][start:stop]
+        if stop <= start:
+            return b''
+        id_str = b2a_base64(id, newline=False).rstrip(b'=').translate(_urlsafe_encode_translation)
+        response = self._g.get('/raw/' + id_str.decode(), headers={'Range': f'bytes={start}-{stop-1}'})
+        if response.status_code == 206:
+            return response.content
+        # the gateway sent everything
+        return response.content[start:stop]
+
     def fetch_size(self, id):
+        pending = self._queued(id)
+        if pending is not None:
+            encoded, off = pending
+            return len(encoded) - off
         id_str = b2a_base64(id, newline=False).rstrip(b'=').translate(_urlsafe_encode_translation)
-        return int(self.__.head(self._c[0] + '/raw/' + id_str.decode()).headers['Content-Length'])
+        return int(self._g.head('/raw/' + id_str.decode()).headers['Content-Length'])
         #return int(self._r._request('raw', id_str.decode(), method='HEAD').headers['Content-Length'])
+
+if __name__ == '__main__':
+    # stand-in gateways on localhost: one fast, one slow, one failing
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    import threading
+    def serve(delay, status):
+        class Handler(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                body = self.path.encode() * 64 if status == 200 else b''
+                time.sleep(delay)
+                range = self.headers.get('Range')
+                if range is not None and status == 200:
+                    start, stop = range.removeprefix('bytes=').split('-')
+                    body = body[int(start):int(stop)+1]
+                    self.send_response(206)
+                else:
+                    self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                return body
+            def do_GET(self):
+                body = self.do_HEAD()
+                if status == 200:
+                    self.wfile.write(body)
+            def log_message(self, *params):
+                pass
+        ThreadingHTTPServer.request_queue_size = 64
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{server.server_port}'
+    fast, slow, failing = serve(0.01, 200), serve(0.25, 200), serve(0, 500)
+    paths = [f'/raw/{idx}' for idx in range(256)]
+    for urls in [[fast], [slow], [failing, slow, fast], [slow, fast]]:
+        gateways = Gateways(urls, hedge_after=0.05)
+        start = time.perf_counter()
+        for path in paths[:16]:
+            assert gateways.get(path).content == path.encode() * 64
+        serial = time.perf_counter() - start
+        with ThreadPoolExecutor(16) as pool:
+            start = time.perf_counter()
+            datas = list(pool.map(lambda path: gateways.get(path).content, paths))
+            sizes = list(pool.map(lambda path: int(gateways.head(path).headers['Content-Length']), paths))
+            parallel = time.perf_counter() - start
+        assert datas == [path.encode() * 64 for path in paths]
+        assert sizes == [len(data) for data in datas]
+        names = { fast: 'fast', slow: 'slow', failing: 'failing' }
+        print(','.join([names[url] for url in urls]),
+              f'serial {serial/16*1000:.1f}ms/req parallel {parallel/len(paths)/2*1000:.1f}ms/req',
+              f'hedged {gateways.hedged} failed over {gateways.failed_over}',
+              'latency', { names[url]: None if latency is None else round(latency*1000, 1) for url, latency in gateways.latency.items() })
+    gateways = Gateways([fast, slow])
+    response = gateways.get('/raw/0', headers={'Range': 'bytes=5-9'})
+    assert response.status_code == 206 and response.content == (b'/raw/0' * 64)[5:10]
+    gateways = Gateways([failing])
+    try:
+        gateways.get('/raw/0')
+        assert not 'failing gateway succeeded'
+    except requests.HTTPError:
+        pass
+
+    # write-behind over a stand-in node that fails when asked to
+    import hashlib, random
+    class Node:
+        def __init__(self, manager):
+            self.manager = manager
+            self.sent = {}
+            self.fail = lambda: False
+            self.up = threading.Event() # sends wait while this is clear
+            self.up.set()
+            self.attempts = 0
+            self.most_pending = 0
+        def send_tx(self, encoded):
+            self.up.wait()
+            self.attempts += 1
+            self.most_pending = max(self.most_pending, self.manager._pending_size)
+            time.sleep(0.002)
+            if self.fail():
+                raise OSError('node unavailable')
+            self.sent[self.manager._id(encoded)] = encoded
+    manager = object.__new__(aR)
+    manager._start_uploads(8, True, 1 << 12, 8)
+    manager.backoff = 0.001
+    manager._id = lambda encoded: hashlib.sha256(encoded).digest()
+    manager._e = Node(manager)
+    random.seed(0)
+    # queued data is readable before it is sent
+    manager._e.up.clear()
+    datas = [random.randbytes(random.randint(1, 512)) for x in range(4)]
+    ids = [manager._send(b'header' + data, len(data)) for data in datas]
+    for id, data in zip(ids, datas):
+        assert manager.fetch(id) == data and manager.fetch_size(id) == len(data)
+        assert manager.fetch_range(id, 1, 5) == data[1:5]
+    manager._e.up.set()
+    # flaky sends are retried and the queue stays bounded
+    manager._e.fail = lambda: random.random() < 0.3
+    datas = [random.randbytes(random.randint(1, 512)) for x in range(64)]
+    ids += [manager._send(b'header' + data, len(data)) for data in datas]
+    with manager:
+        pass
+    assert not manager._pending and manager._pending_size == 0
+    assert sorted(manager._e.sent) == sorted(set(ids))
+    assert manager._e.most_pending <= manager.pending_bytes
+    print(f'write-behind: {manager._e.attempts} sends for {len(set(ids))} uploads, at most {manager._e.most_pending} bytes queued')
+    # uploads out of retries raise once each, stay readable, and can be retried
+    manager.retries = 1
+    manager._e.fail = lambda: True
+    lost = [manager._send(b'header' + data, len(data)) for data in [b'lost', b'also lost']]
+    for id in lost:
+        try:
+            manager.flush()
+            assert not 'failed upload passed'
+        except OSError:
+            pass
+    manager.flush()
+    assert manager.fetch(lost[0]) == b'lost' and manager.fetch(lost[1]) == b'also lost'
+    assert manager._pending_size == 0
+    manager._e.fail = lambda: False
+    assert manager.retry() == 2
+    manager.flush()
+    assert all(id in manager._e.sent for id in lost) and not manager._failed
+
+    # signing throughput with rsa keys like those of wallets
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    class RSASigner:
+        def __init__(self, pem):
+            self.key = serialization.load_pem_private_key(pem, password=None)
+        def header(self, data):
+            return self.key.sign(data, padding.PSS(padding.MGF1(hashes.SHA256()), 32), hashes.SHA256())
+    pem = rsa.generate_private_key(65537, 4096).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    datas = [os.urandom(1 << 16) for x in range(192)]
+    start = time.perf_counter()
+    signer = RSASigner(pem)
+    for data in datas:
+        signer.header(data)
+    print(f'signing in this process {len(datas)/(time.perf_counter()-start):.0f}/s')
+    public = signer.key.public_key()
+    for processes in sorted(set([1, 2, 4, os.cpu_count()])):
+        signers = Signers(RSASigner, pem, processes=processes)
+        signers.headers(datas[:processes]) # start the processes
+        start = time.perf_counter()
+        headers = signers.headers(datas)
+        print(f'signing in {processes} processes {len(datas)/(time.perf_counter()-start):.0f}/s')
+        for header, data in zip(headers, datas):
+            public.verify(header, data, padding.PSS(padding.MGF1(hashes.SHA256()), 32), hashes.SHA256())
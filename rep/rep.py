@@ -1,25 +1,83 @@
 from .r import aR as manager
 #from .i import fI as manager
+from .manager import Manager, Batched
 
-import tqdm
+import collections
 
 class Rep:
-    def __init__(self, manager=None):
+    # chunks pass through at most window at a time, in order. with an
+    # executor each chunk is its own task, otherwise windows are batched.
+    # a chunker from .chunk cuts data by content instead of at allocsize.
+    def __init__(self, manager=None, executor=None, window=64, chunker=None):
         if manager is None:
             manager = globals()['manager']()
+        if not isinstance(manager, Manager):
+            manager = Batched(manager)
         self.manager = manager
-    def alloc(self, data, replacing=b''):
+        self.executor = executor
+        self.window = window
+        self.chunker = chunker
+    def split(self, data):
+        # the chunks data is stored as
+        sz = self.manager.allocsize
+        if self.chunker is not None:
+            return [bytes(piece) for piece in self.chunker.split(data, sz)]
+        return [data[off:off+sz] for off in range(0,len(data),sz)]
+    def _pipeline(self, one, many, items):
+        # yields the results for items in order
+        if self.executor is None:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) == self.window:
+                    yield from many(batch)
+                    batch = []
+            if batch:
+                yield from many(batch)
+        else:
+            pending = collections.deque()
+            for item in items:
+                if len(pending) == self.window:
+                    yield pending.popleft().result()
+                pending.append(self.executor.submit(one, item))
+            while pending:
+                yield pending.popleft().result()
+    def _chunks(self, source):
+        # allocsize pieces from a file object or an iterable of bytes
         sz = self.manager.allocsize
-        return b''.join([
-            self.manager.alloc(data[off:off+sz], replacing=[replacing[idx:idx+sz] for idx in range(0,len(replacing),sz)])
-            for off in range(0,len(data),sz)
-        ])
+        read = getattr(source, 'read', None)
+        if read is not None:
+            source = iter(lambda: read(sz), b'')
+        buf = bytearray()
+        for data in source:
+            buf += data
+            while len(buf) >= sz:
+                length = sz if self.chunker is None else self.chunker.cut(buf, sz)
+                yield bytes(buf[:length])
+                del buf[:length]
+        for piece in self.split(buf):
+            yield bytes(piece)
+    def _alloc_pieces(self, pieces, replacing):
+        idsz = self.manager.idsize
+        replacing = [replacing[idx:idx+idsz] for idx in range(0,len(replacing),idsz)]
+        return self._pipeline(
+            lambda data: self.manager.alloc(data, replacing=replacing),
+            lambda datas: self.manager.alloc_many(datas, replacing=replacing),
+            pieces)
+    def alloc(self, data, replacing=b''):
+        return b''.join(self._alloc_pieces(self.split(data), replacing))
+    def alloc_stream(self, source, replacing=b''):
+        # yields the id of each chunk of a file object or iterable of bytes
+        return self._alloc_pieces(self._chunks(source), replacing)
     def fetch(self, id):
+        return b''.join(self.fetch_stream(id))
+    def fetch_stream(self, id):
+        # yields the data of each chunk of id
         sz = self.manager.idsize
-        return b''.join([
-            self.manager.fetch(id[off:off+sz])
+        return self._pipeline(self.manager.fetch, self.manager.fetch_many, (
+            id[off:off+sz]
             for off in range(0,len(id),sz)
-        ])
+        ))
 
 class Document:
     def __init__(self, id=b'', rep=None):
@@ -81,36 +139,65 @@ class Document:
         if old_id in old_ids:
             self.rep.manager.dealloc(old_id)
 
-import bisect, itertools
+import array, sys
+from .table import ChunkTable
 class ResizeableDocument:
-    def __init__(self, id=b'', rep=None):
+    # sized documents keep chunk sizes in their id so opening them does not
+    # fetch every chunk's size. the id is then a marker the length of an id,
+    # the ids, and a 4-byte little-endian size per chunk.
+    # paged documents store their ids and sizes in the rep as a tree of pages
+    # (see ChunkTable.store), so the id is a second marker and the id of the
+    # root page, whatever the length. reading the id stores changed pages.
+    range_fraction = 8 # reads within a chunk under this fraction of it fetch only their range
+    fsck_edits = False # check the whole document, fetching every size, after each edit
+    def __init__(self, id=b'', rep=None, sized=False, paged=False):
         if rep is None:
             rep = Rep()
         self.rep = rep
         self._idsize = self.rep.manager.idsize
         self._allocsize = self.rep.manager.allocsize
         sz = self._idsize
-        self._ids = [id[off:off+sz] for off in range(0, len(id), sz)]
-        self._sizes = [self.rep.manager.fetch_size(id) for id in self._ids]
-        self._offs = list(itertools.accumulate(self._sizes, initial=0))
+        marker = b'\xff' * sz
+        self.paged = paged or id[:sz] == b'\xfe' * sz
+        block = ChunkTable.fanout(sz, self._allocsize) // 2 if self.paged else 512
+        if id[:sz] == b'\xfe' * sz:
+            self._table = ChunkTable.open(sz, id[sz:sz*2], self.rep.manager, block)
+            self.sized = sized
+            return
+        if id[:sz] == marker:
+            sized = True
+            count = (len(id) - sz) // (sz + 4)
+            sizes = array.array('I', id[sz+count*sz:])
+            if sys.byteorder != 'little':
+                sizes.byteswap()
+            id = id[sz:sz+count*sz]
+        elif len(id):
+            sizes = self.rep.manager.fetch_size_many([id[off:off+sz] for off in range(0, len(id), sz)])
+        else:
+            sizes = []
+        self._table = ChunkTable(sz, id, sizes, block)
+        self.sized = sized
     @property
     def id(self):
-        return b''.join(self._ids)
+        if self.paged:
+            return b'\xfe' * self._idsize + self._table.store(self.rep.manager)
+        if not self.sized:
+            return self._table.packed_ids()
+        return b''.join([b'\xff' * self._idsize, self._table.packed_ids(), self._table.packed_sizes()])
     def _idx2off(self, idx):
-        return sum(self._sizes[:idx])
+        return self._table.offset(idx)
     def _off2idxoff(self, off, lo=0, hi=None):
-        idx = bisect.bisect_right(self._offs, off, lo, hi) - 1
-        assert off >= self._offs[idx]
-        return [idx, off - self._offs[idx]]
+        return self._table.find(off)
     def offset_to_id(self, offset):
         idx, off = self._off2idxoff(offset)
-        return self._ids[idx]
+        return self._table.id(idx)
     def fsck(self):
-        assert 0 not in self._sizes
-        assert self._sizes == [self.rep.manager.fetch_size(id) for id in tqdm.tqdm(self._ids, desc='fsck sizes', leave=False)]
-        assert self._offs == list(itertools.accumulate(self._sizes, initial=0))
+        sizes = self._table.sizes()
+        assert 0 not in sizes
+        assert sizes == self.rep.manager.fetch_size_many(self._table.ids())
+        assert self._table.total == sum(sizes)
     def __len__(self):
-        return self._offs[-1]
+        return self._table.total
     def __getitem__(self, slice):
         start, stop, step = slice.indices(len(self))
         start_idx, start_off = self._off2idxoff(start)
@@ -120,42 +207,67 @@ class ResizeableDocument:
                 stop_off = None
                 last_idx = stop_idx - 1
             else:
-                stop_off -= self._sizes[stop_idx]
+                stop_off -= self._table.size(stop_idx)
                 last_idx = stop_idx
                 stop_idx += 1
         elif stop_off > start_off:
-            stop_off -= self._sizes[stop_idx]
+            stop_off -= self._table.size(stop_idx)
             last_idx = stop_idx
             stop_idx += 1
         else:
             assert start_idx == stop_idx
             assert start_off == stop_off
             return b''
-        datas = [self.rep.manager.fetch(id) for id in self._ids[start_idx:stop_idx]]
+        if last_idx == start_idx and (stop - start) * self.range_fraction <= self._table.size(start_idx):
+            data = self.rep.manager.fetch_range(self._table.id(start_idx), start_off, start_off + stop - start)
+            if step != 1:
+                data = data[::step]
+            return data
+        datas = self.rep.manager.fetch_view_many(self._table.ids(start_idx, stop_idx))
         datas[0] = datas[0][start_off:]
         datas[-1] = datas[-1][:stop_off]
-        data = b''.join(datas)[::step]
-        assert len(data) == (stop - start) // step
+        data = b''.join(datas)
+        if step != 1:
+            data = data[::step]
+        assert len(data) == len(range(start, stop, step))
         return data
+    def readinto(self, buffer, start=0, stop=None):
+        # copies bytes start:stop directly into buffer, returning the count
+        start, stop, step = slice(start, stop).indices(len(self))
+        if stop <= start:
+            return 0
+        buffer = memoryview(buffer).cast('B')
+        length = stop - start
+        assert len(buffer) >= length
+        start_idx, off = self._off2idxoff(start)
+        stop_idx, stop_off = self._off2idxoff(stop - 1, start_idx)
+        pos = 0
+        for view in self.rep.manager.fetch_view_many(self._table.ids(start_idx, stop_idx+1)):
+            piece = view[off:off+length-pos]
+            buffer[pos:pos+len(piece)] = piece
+            pos += len(piece)
+            off = 0
+        assert pos == length
+        return length
     def __iter__(self):
-        for id in self._ids:
-            yield self.rep.manager.fetch(id)
+        # the data of each chunk, fetched ahead through the rep's pipeline
+        return self.rep._pipeline(self.rep.manager.fetch, self.rep.manager.fetch_many, self._table.ids())
     def __setitem__(self, slice, data):
         start, stop, step = slice.indices(len(self))
         assert step == 1
         start_idx, start_off = self._off2idxoff(start)
         stop_idx, stop_off = self._off2idxoff(stop, start_idx)
-        old_ids = self._ids[start_idx:stop_idx]
+        old_ids = self._table.ids(start_idx, stop_idx)
 
         # note: additional prefix and suffix material could be added to defrag the content so long as idx count did not increase
         if start_off > 0:
-            prefix = self.rep.manager.fetch(self._ids[start_idx])[:start_off]
+            prefix = self.rep.manager.fetch(self._table.id(start_idx))[:start_off]
             prefixlen = start_off
         else:
             prefix = b''
             prefixlen = 0
         if stop_off > 0:
-            suffix = self.rep.manager.fetch(self._ids[stop_idx])[stop_off:]
+            suffix = self.rep.manager.fetch(self._table.id(stop_idx))[stop_off:]
             suffixlen = len(suffix)
             stop_idx += 1
         else:
@@ -164,46 +276,97 @@ class ResizeableDocument:
         datalen = len(data)
         sz = self._allocsize
 
-        new_ids = []
-        new_sizes = []
-        alloc = self.rep.manager.alloc
-        if prefixlen + datalen < sz:
+        pieces = []
+        if self.rep.chunker is not None:
+            pieces = self.rep.split(prefix + data[:] + suffix)
+            suffixoff = suffixlen
+        elif prefixlen + datalen < sz:
             suffixoff = sz - prefixlen - datalen
             if suffixlen + prefixlen + datalen > 0:
-                piece = prefix + data[:] + suffix[:suffixoff]
-                new_sizes.append(len(piece))
-                new_ids.append(alloc(piece, replacing=old_ids))
+                pieces.append(prefix + data[:] + suffix[:suffixoff])
         else:
             off = sz - prefixlen
-            piece = prefix + data[:off]
-            new_sizes.append(len(piece))
-            new_ids.append(alloc(piece, replacing=old_ids))
+            pieces.append(prefix + data[:off])
             offs = list(range(off, datalen, sz))
-            for off in offs[:-1]:
-                piece = data[off:off+sz]
-                new_sizes.append(len(piece))
-                new_ids.append(alloc(piece, replacing=old_ids))
-            tail = data[offs[-1]:]
-            suffixoff = sz - len(tail)
-            piece = tail + suffix[:suffixoff]
-            new_sizes.append(len(piece))
-            new_ids.append(alloc(piece, replacing=old_ids))
+            if len(offs):
+                for off in offs[:-1]:
+                    pieces.append(data[off:off+sz])
+                tail = data[offs[-1]:]
+                suffixoff = sz - len(tail)
+                pieces.append(tail + suffix[:suffixoff])
+            else:
+                # the first piece was filled exactly
+                suffixoff = 0
         if suffixoff < suffixlen:
-            piece = suffix[suffixoff:]
-            new_sizes.append(len(piece))
-            new_ids.append(alloc(piece, replacing=old_ids))
-        self._ids[start_idx:stop_idx] = new_ids#[self.rep.manager.alloc(data_item) for data_item in data_array]
-        self._sizes[start_idx:stop_idx] = new_sizes#[len(data_item) for data_item in data_array]
-        self._offs[start_idx:] = itertools.accumulate(self._sizes[start_idx:], initial=self._offs[start_idx])
-        self.fsck()
+            pieces.append(suffix[suffixoff:])
+        new_ids = self.rep.manager.alloc_many(pieces, replacing=old_ids)
+        new_sizes = [len(piece) for piece in pieces]
+        self._table.replace(start_idx, stop_idx, new_ids, new_sizes)#[self.rep.manager.alloc(data_item) for data_item in data_array]
+        if self.fsck_edits:
+            self.fsck()
     def update(self, *start_stop_data):
-        start_stop_data = list(start_stop_data)
-        start_stop_data.sort()
-        # group them by id
-        # i'm not sure i have the capacity rn to implement this algorithm reasonably. some parts expressing a lot of hopelessness/etc repeatedly/persistently/aggressively
-            # irritating. we're looking for a simpler way to make the structures usable.
-            # basically, dicts are sparse. we'd like to perform a number of updates at once.
-            # i guess that means fetching each id, and placing new data into it at once.
+        # replaces many non-overlapping ranges at once, each [start, stop, data]
+        # in offsets from before the update. edits sharing chunks are grouped,
+        # each chunk is fetched once, and all new chunks are allocated in one
+        # batch. returns the number of chunks rewritten.
+        start_stop_data = sorted(start_stop_data, key=lambda edit: edit[:2])
+        table = self._table
+        groups = [] # [first chunk, chunk after last, edits]
+        for start, stop, data in start_stop_data:
+            assert start <= stop <= len(self)
+            assert not groups or groups[-1][2][-1][1] <= start
+            start_idx, start_off = table.find(start)
+            if stop > start:
+                stop_idx = table.find(stop - 1)[0] + 1
+            elif start_off > 0:
+                stop_idx = start_idx + 1
+            else:
+                stop_idx = start_idx
+            if groups and start_idx < groups[-1][1]:
+                groups[-1][1] = max(groups[-1][1], stop_idx)
+                groups[-1][2].append([start, stop, data])
+            else:
+                groups.append([start_idx, stop_idx, [[start, stop, data]]])
+        old_ids = [table.ids(start_idx, stop_idx) for start_idx, stop_idx, edits in groups]
+        olds = iter(self.rep.manager.fetch_many(sum(old_ids, [])))
+        pieces = []
+        for start_idx, stop_idx, edits in groups:
+            old = b''.join([next(olds) for idx in range(start_idx, stop_idx)])
+            base = table.offset(start_idx)
+            content = bytearray()
+            pos = 0
+            for start, stop, data in edits:
+                content += old[pos:start-base]
+                content += data[:]
+                pos = stop - base
+            content += old[pos:]
+            pieces.append(self.rep.split(content))
+        new_ids = iter(self.rep.manager.alloc_many(sum(pieces, []), replacing=sum(old_ids, [])))
+        new_ids = [[next(new_ids) for piece in group_pieces] for group_pieces in pieces]
+        for [start_idx, stop_idx, edits], group_ids, group_pieces in reversed(list(zip(groups, new_ids, pieces))):
+            table.replace(start_idx, stop_idx, group_ids, [len(piece) for piece in group_pieces])
+        if self.fsck_edits:
+            self.fsck()
+        return sum([stop_idx - start_idx for start_idx, stop_idx, edits in groups])
+    def replace_chunks(self, start_idx, stop_idx, pieces):
+        # replaces chunks start_idx:stop_idx with a chunk for each of pieces,
+        # for callers that choose where chunks are cut
+        old_ids = self._table.ids(start_idx, stop_idx)
+        new_ids = self.rep.manager.alloc_many(pieces, replacing=old_ids)
+        self._table.replace(start_idx, stop_idx, new_ids, [len(piece) for piece in pieces])
+        if self.fsck_edits:
+            self.fsck()
+    def rewrite(self):
+        # pick up the current ids of chunks the manager has moved, retiring
+        # the old ids. returns the number of ids that changed.
+        retire = getattr(self.rep.manager, 'retire', None)
+        if retire is None:
+            return 0
+        old_ids = self._table.ids()
+        ids = [retire(id) for id in old_ids]
+        changed = sum([id != old_id for id, old_id in zip(ids, old_ids)])
+        self._table.replace(0, len(ids), ids, self._table.sizes())
+        return changed
     def __iadd__(self, data):
         # reusing setitem for coverage
         self[len(self):] = data
@@ -246,6 +409,7 @@ class IterableWithLength:
 
 if __name__ == '__main__':
     import random, tqdm, time
+    ResizeableDocument.fsck_edits = True
     for seed in [1745156337, int(time.time())]:
         print(f'random.seed({seed})')
         random.seed(seed)
@@ -270,3 +434,14 @@ if __name__ == '__main__':
         doc += text
         cmp += text
         assert doc[:] == cmp
+        for sized in [False, True]:
+            doc.sized = sized
+            reopened = ResizeableDocument(doc.id, doc.rep)
+            assert reopened.sized == sized
+            assert reopened._table.sizes() == doc._table.sizes()
+            assert reopened[:] == cmp
+        paged = ResizeableDocument(doc.id, doc.rep, paged=True)
+        reopened = ResizeableDocument(paged.id, doc.rep)
+        assert reopened.paged and len(paged.id) == 2 * paged._idsize
+        assert reopened._table.sizes() == doc._table.sizes()
+        assert reopened[:] == cmp
@@ -0,0 +1,166 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+class DocumentReader(io.RawIOBase):
+    # reads a ResizeableDocument as a seekable file. the chunks after the one
+    # being read are fetched in the background, readahead at a time, on the
+    # document's executor or a pool of the reader's own.
+    def __init__(self, doc, readahead=8, executor=None):
+        self.doc = doc
+        self.readahead = readahead
+        self._pos = 0
+        self._fetches = {} # chunk idx -> future
+        self._own_executor = None
+        if executor is None:
+            executor = doc.rep.executor
+        if executor is None and readahead:
+            executor = ThreadPoolExecutor(readahead)
+            self._own_executor = executor
+        self._executor = executor
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def tell(self):
+        return self._pos
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self.doc)
+        if offset < 0:
+            raise ValueError('negative seek position')
+        self._pos = offset
+        return offset
+    def _chunk(self, idx):
+        # the data of chunk idx, fetching those after it in the background
+        fetches = self._fetches
+        # fetches outside the window, as after a seek, are dropped
+        for stale in [other for other in fetches if not idx <= other <= idx + self.readahead]:
+            fetches.pop(stale).cancel()
+        if self.readahead:
+            ids = self.doc._table.ids(idx, idx + self.readahead + 1)
+            for next_idx, id in enumerate(ids, idx):
+                if next_idx not in fetches:
+                    fetches[next_idx] = self._executor.submit(self.doc.rep.manager.fetch, id)
+            return fetches.pop(idx).result()
+        return self.doc.rep.manager.fetch(self.doc._table.id(idx))
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        length = min(len(buffer), len(self.doc) - self._pos)
+        if length <= 0:
+            return 0
+        idx, off = self.doc._off2idxoff(self._pos)
+        pos = 0
+        while pos < length:
+            piece = self._chunk(idx)[off:off+length-pos]
+            buffer[pos:pos+len(piece)] = piece
+            pos += len(piece)
+            idx += 1
+            off = 0
+        self._pos += length
+        return length
+    def close(self):
+        for future in self._fetches.values():
+            future.cancel()
+        self._fetches.clear()
+        if self._own_executor is not None:
+            self._own_executor.shutdown(wait=False)
+            self._own_executor = None
+        super().close()
+
+class DocumentWriter(io.RawIOBase):
+    # appends to a ResizeableDocument as a file. writes are gathered into
+    # batches of window chunks, each appended with one batched allocation,
+    # so memory stays at about a window whatever is written.
+    def __init__(self, doc, window=None):
+        self.doc = doc
+        if window is None:
+            window = doc.rep.window
+        self._limit = window * doc.rep.manager.allocsize
+        self._buffer = bytearray()
+    def writable(self):
+        return True
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self._limit:
+            self.flush()
+        return len(data)
+    def write_from(self, source):
+        # appends everything from a file object or iterable of bytes
+        read = getattr(source, 'read', None)
+        if read is not None:
+            source = iter(lambda: read(self._limit), b'')
+        for data in source:
+            self.write(data)
+    def flush(self):
+        if self._buffer:
+            self.doc += self._buffer
+            self._buffer = bytearray()
+    def close(self):
+        if not self.closed:
+            self.flush()
+        super().close()
+
+class BufferedDocumentWriter(io.BufferedWriter):
+    # a buffered DocumentWriter. flush reaches the document, and write_from
+    # appends after what is already buffered.
+    def flush(self):
+        super().flush()
+        self.raw.flush()
+    def write_from(self, source):
+        super().flush()
+        self.raw.write_from(source)
+
+def open(doc, mode='rb', readahead=8, buffering=io.DEFAULT_BUFFER_SIZE):
+    # a buffered file over a document, for reading or appending
+    if mode in ['r', 'rb']:
+        return io.BufferedReader(DocumentReader(doc, readahead), buffering)
+    if mode in ['a', 'ab', 'w', 'wb']:
+        if mode[0] == 'w':
+            doc[:] = b''
+        return BufferedDocumentWriter(DocumentWriter(doc), buffering)
+    raise ValueError(f'unsupported mode {mode!r}')
+
+if __name__ == '__main__':
+    import atexit, hashlib, os, random, shutil, tempfile, time
+    from .i import fI
+    from .manager import Slow
+    from .rep import Rep, ResizeableDocument
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as dir:
+        store = fI(os.path.join(dir, 'stream.d'))
+        atexit.unregister(store.shrink)
+        rep = Rep(Slow(store, 0.002), window=16)
+        data = random.randbytes(1 << 21)
+        doc = ResizeableDocument(rep=rep)
+        with open(doc, 'wb') as file:
+            file.write(data[:1000])
+            file.write_from(iter([data[1000:5000], data[5000:1<<20]]))
+        with open(doc, 'ab') as file:
+            file.write(data[1<<20:(1<<20)+5])
+            file.flush()
+            assert len(doc) == (1 << 20) + 5
+            shutil.copyfileobj(io.BytesIO(data[(1<<20)+5:]), file)
+        assert doc[:] == data
+        for readahead in [0, 4, 16]:
+            with open(doc, 'rb', readahead=readahead) as file:
+                start = time.perf_counter()
+                digest = hashlib.file_digest(file, 'sha256').digest()
+                duration = time.perf_counter() - start
+            assert digest == hashlib.sha256(data).digest()
+            print(f'readahead {readahead}: {len(data)/duration/(1<<20):.1f}MiB/s')
+        with open(doc, 'rb') as file:
+            for it in range(200):
+                off = random.randrange(len(data) + 10)
+                length = random.randint(0, 10000)
+                assert file.seek(off) == off
+                assert file.read(length) == data[off:off+length]
+            assert file.seek(-10, io.SEEK_END) == len(data) - 10
+            assert file.read() == data[-10:]
+            # seeking backwards holds no more than a window of chunks
+            for off in range(len(data) - 4096, 0, -len(data) // 40):
+                file.seek(off)
+                assert file.read(16) == data[off:off+16]
+                assert len(file.raw._fetches) <= file.raw.readahead
+        store.shrink()
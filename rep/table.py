@@ -0,0 +1,396 @@
+from bisect import bisect_right
+import array, itertools, sys
+
+class ChunkTable:
+    # the ids and sizes of a document's chunks. chunks are kept in blocks of
+    # up to twice block chunks, with ids packed into a bytearray and sizes in
+    # an array per block. fenwick trees over the blocks count chunks and bytes,
+    # finding a chunk by index or offset in logarithmic time, and an edit
+    # only rewrites the blocks it touches.
+    #
+    # a table can be stored as a tree of pages with store and opened again
+    # with open. each block is a leaf page: a zero level byte, the ids and
+    # 4-byte little-endian sizes. inner pages hold a level byte and, per
+    # child, its id and 8-byte little-endian chunk count and byte total.
+    # an opened table fetches its inner pages and loads leaves when used.
+    def __init__(self, idsize, ids=b'', sizes=(), block=512):
+        self.idsize = idsize
+        self.block = block
+        self._fetch_many = None
+        self._inner = {} # inner page -> id, from the last store
+        self._stale = [] # leaf page ids whose blocks have changed
+        self._build(bytes(ids), array.array('I', sizes))
+    def _build(self, ids, sizes):
+        sz = self.idsize
+        assert len(ids) == len(sizes) * sz
+        self._ids = []
+        self._sizes = []
+        self._offs = []
+        self._pages = [] # per block, [page id, count, total] while it is stored
+        self._bcounts = [] # per block, the number of chunks
+        self._btotals = [] # per block, the bytes in its chunks
+        self._root = None
+        self._split(0, 0, ids, sizes)
+    @staticmethod
+    def fanout(idsize, allocsize):
+        # the number of chunks a leaf page holds
+        return (allocsize - 1) // (idsize + 4)
+    @classmethod
+    def open(cls, idsize, root, manager, block=512):
+        # the table stored under root page id
+        self = cls(idsize, block=block)
+        self._fetch_many = manager.fetch_many
+        entries = [[root, None, None]]
+        while True:
+            pages = manager.fetch_many([entry[0] for entry in entries])
+            if pages[0][0] == 0:
+                # the root is a leaf
+                ids, sizes = self._leaf(pages[0])
+                self._build(ids, sizes)
+                if len(self._pages) == 1:
+                    self._pages[0] = [root, len(sizes), sum(sizes)]
+                break
+            for entry, page in zip(entries, pages):
+                self._inner[bytes(page)] = entry[0]
+            entries = sum([self._entries(page) for page in pages], [])
+            if pages[0][0] == 1:
+                count = len(entries)
+                self._ids = [None] * count
+                self._sizes = [None] * count
+                self._offs = [None] * count
+                self._pages = entries
+                self._bcounts = [entry[1] for entry in entries]
+                self._btotals = [entry[2] for entry in entries]
+                self._tree()
+                break
+        self._root = root
+        return self
+    def _leaf(self, page):
+        count = (len(page) - 1) // (self.idsize + 4)
+        ids = bytes(page[1:1+count*self.idsize])
+        sizes = array.array('I', page[1+count*self.idsize:])
+        if sys.byteorder != 'little':
+            sizes.byteswap()
+        return ids, sizes
+    def _entries(self, page):
+        sz = self.idsize
+        return [
+            [bytes(page[off:off+sz]),
+             int.from_bytes(page[off+sz:off+sz+8], 'little'),
+             int.from_bytes(page[off+sz+8:off+sz+16], 'little')]
+            for off in range(1, len(page), sz + 16)
+        ]
+    def _load(self, bs):
+        # fetches the leaves of blocks bs that are not loaded yet
+        bs = [b for b in bs if self._sizes[b] is None]
+        if not bs:
+            return
+        pages = self._fetch_many([self._pages[b][0] for b in bs])
+        for b, page in zip(bs, pages):
+            ids, sizes = self._leaf(page)
+            assert len(sizes) == self._pages[b][1]
+            self._ids[b] = bytearray(ids)
+            self._sizes[b] = sizes
+    def _dirty(self, b0, b1):
+        # blocks b0:b1 are changing and need storing again
+        self._stale.extend([page[0] for page in self._pages[b0:b1] if page is not None])
+        self._root = None
+    def store(self, manager):
+        # writes the blocks changed since the last store and the inner pages
+        # above them, returning the id of the root page
+        if self._root is not None:
+            return self._root
+        dirty = [b for b, page in enumerate(self._pages) if page is None]
+        if not self._sizes:
+            self._root = manager.alloc(b'\0', replacing=self._stale)
+            self._stale = []
+            return self._root
+        leaves = []
+        for b in dirty:
+            sizes = array.array('I', self._sizes[b])
+            if sys.byteorder != 'little':
+                sizes.byteswap()
+            leaves.append(b'\0' + self._ids[b] + sizes.tobytes())
+        for b, id in zip(dirty, manager.alloc_many(leaves, replacing=self._stale)):
+            self._pages[b] = [id, len(self._sizes[b]), sum(self._sizes[b])]
+        self._stale = []
+        fanout = (manager.allocsize - 1) // (self.idsize + 16)
+        entries = self._pages
+        inner = {}
+        level = 1
+        while len(entries) > 1:
+            groups = [entries[off:off+fanout] for off in range(0, len(entries), fanout)]
+            pages = [
+                bytes([level]) + b''.join([
+                    id + count.to_bytes(8, 'little') + total.to_bytes(8, 'little')
+                    for id, count, total in group
+                ])
+                for group in groups
+            ]
+            # pages unchanged since the last store keep their ids
+            new = [page for page in pages if page not in self._inner]
+            kept = set(pages)
+            old = [id for page, id in self._inner.items() if page[0] == level and page not in kept]
+            ids = iter(manager.alloc_many(new, replacing=old))
+            for page in pages:
+                inner[page] = self._inner[page] if page in self._inner else next(ids)
+            entries = [
+                [inner[page], sum([entry[1] for entry in group]), sum([entry[2] for entry in group])]
+                for page, group in zip(pages, groups)
+            ]
+            level += 1
+        self._inner = inner
+        self._root = entries[0][0]
+        return self._root
+    def _split(self, b0, b1, ids, sizes):
+        # replaces blocks b0:b1 with blocks holding ids and sizes
+        sz = self.idsize
+        count = len(sizes)
+        nblocks = (count + self.block - 1) // self.block
+        bounds = [count * idx // nblocks for idx in range(nblocks + 1)] if nblocks else [0]
+        blocks = [sizes[start:stop] for start, stop in zip(bounds, bounds[1:])]
+        old_counts = self._bcounts[b0:b1]
+        old_totals = self._btotals[b0:b1]
+        self._ids[b0:b1] = [bytearray(ids[start*sz:stop*sz]) for start, stop in zip(bounds, bounds[1:])]
+        self._sizes[b0:b1] = blocks
+        self._offs[b0:b1] = [None] * nblocks
+        self._bcounts[b0:b1] = [len(block) for block in blocks]
+        self._btotals[b0:b1] = [sum(block) for block in blocks]
+        self._dirty(b0, b1)
+        self._pages[b0:b1] = [None] * nblocks
+        if b1 > b0 and nblocks == b1 - b0:
+            # the blocks stay where they were, so only their nodes change
+            for b, old_count, old_total in zip(range(b0, b1), old_counts, old_totals):
+                self._add(self._counts, b, self._bcounts[b] - old_count)
+                self._add(self._totals, b, self._btotals[b] - old_total)
+                self.count += self._bcounts[b] - old_count
+                self.total += self._btotals[b] - old_total
+        else:
+            self._tree()
+    def _tree(self):
+        # builds the fenwick trees of block chunk counts and byte totals
+        n = len(self._sizes)
+        counts = [0] + self._bcounts
+        totals = [0] + self._btotals
+        self.count = sum(counts)
+        self.total = sum(totals)
+        for idx in range(1, n + 1):
+            parent = idx + (idx & -idx)
+            if parent <= n:
+                counts[parent] += counts[idx]
+                totals[parent] += totals[idx]
+        self._counts = counts
+        self._totals = totals
+        self._top = 1 << n.bit_length() >> 1 if n else 0
+    def _add(self, tree, b, delta):
+        b += 1
+        while b < len(tree):
+            tree[b] += delta
+            b += b & -b
+    def _prefix(self, tree, b):
+        # the sum over blocks before b
+        result = 0
+        while b > 0:
+            result += tree[b]
+            b -= b & -b
+        return result
+    def _descend(self, tree, value):
+        # the first block whose prefix sum including it exceeds value, and
+        # value less the blocks before it
+        pos = 0
+        step = self._top
+        while step:
+            if pos + step < len(tree) and tree[pos + step] <= value:
+                pos += step
+                value -= tree[pos]
+            step >>= 1
+        return pos, value
+    def _block_offs(self, b):
+        offs = self._offs[b]
+        if offs is None:
+            self._load([b])
+            offs = array.array('Q', itertools.accumulate(self._sizes[b], initial=0))
+            self._offs[b] = offs
+        return offs
+    def _locate(self, idx):
+        # the block holding chunk idx and its index there. idx may be count.
+        if idx >= self.count:
+            b = len(self._sizes) - 1
+            if b < 0:
+                return b, 0
+            self._load([b])
+            return b, len(self._sizes[b])
+        return self._descend(self._counts, idx)
+    def __len__(self):
+        return self.count
+    def find(self, off):
+        # the index of the chunk holding byte off and off within it
+        if off >= self.total:
+            return [self.count, off - self.total]
+        b, off = self._descend(self._totals, off)
+        offs = self._block_offs(b)
+        local = bisect_right(offs, off) - 1
+        return [self._prefix(self._counts, b) + local, off - offs[local]]
+    def offset(self, idx):
+        # the offset of the start of chunk idx
+        if idx >= self.count:
+            return self.total
+        b, local = self._descend(self._counts, idx)
+        return self._prefix(self._totals, b) + self._block_offs(b)[local]
+    def id(self, idx):
+        b, local = self._descend(self._counts, idx)
+        self._load([b])
+        sz = self.idsize
+        return bytes(self._ids[b][local*sz:(local+1)*sz])
+    def size(self, idx):
+        b, local = self._descend(self._counts, idx)
+        self._load([b])
+        return self._sizes[b][local]
+    def _range(self, start, stop):
+        # each block overlapping chunks start:stop and the part of it, loaded
+        stop = min(stop, self.count)
+        if start >= stop:
+            return []
+        b, local = self._descend(self._counts, start)
+        left = stop - start
+        result = []
+        while left > 0:
+            count = self._bcounts[b]
+            end = min(count, local + left)
+            result.append([b, local, end])
+            left -= end - local
+            b += 1
+            local = 0
+        self._load([b for b, local, end in result])
+        return result
+    def ids(self, start=0, stop=None):
+        if stop is None:
+            stop = self.count
+        sz = self.idsize
+        result = []
+        for b, local, end in self._range(start, stop):
+            ids = self._ids[b]
+            result.extend([bytes(ids[off:off+sz]) for off in range(local*sz, end*sz, sz)])
+        return result
+    def sizes(self, start=0, stop=None):
+        if stop is None:
+            stop = self.count
+        result = []
+        for b, local, end in self._range(start, stop):
+            result.extend(self._sizes[b][local:end])
+        return result
+    def blocks(self):
+        # [count, total, sizes] for each block, sizes None while not loaded
+        return [list(block) for block in zip(self._bcounts, self._btotals, self._sizes)]
+    def packed_ids(self):
+        self._load(range(len(self._sizes)))
+        return b''.join(self._ids)
+    def packed_sizes(self):
+        # sizes as 4-byte little-endian integers
+        self._load(range(len(self._sizes)))
+        sizes = array.array('I', b''.join([sizes.tobytes() for sizes in self._sizes]))
+        if sys.byteorder != 'little':
+            sizes.byteswap()
+        return sizes.tobytes()
+    def replace(self, start, stop, ids, sizes):
+        # replaces chunks start:stop with chunks of ids and sizes
+        sz = self.idsize
+        packed = b''.join(ids)
+        sizes = array.array('I', sizes)
+        assert len(packed) == len(sizes) * sz
+        if not self._sizes:
+            self._build(packed, sizes)
+            return
+        b0, l0 = self._locate(start)
+        b1, l1 = self._locate(max(start, stop - 1))
+        if stop > start:
+            l1 += 1
+        else:
+            b1, l1 = b0, l0
+        self._load(range(max(b0 - 1, 0), min(b1 + 2, len(self._sizes))))
+        count = len(self._sizes[b0]) - (l1 - l0) + len(sizes)
+        if b0 == b1 and (self.block // 2 <= count or len(self._sizes) == 1) and 0 < count <= 2 * self.block:
+            old_total = sum(self._sizes[b0][l0:l1])
+            self._ids[b0][l0*sz:l1*sz] = packed
+            self._sizes[b0][l0:l1] = sizes
+            self._offs[b0] = None
+            self._dirty(b0, b0 + 1)
+            self._pages[b0] = None
+            count = len(sizes) - (l1 - l0)
+            total = sum(sizes) - old_total
+            self._bcounts[b0] += count
+            self._btotals[b0] += total
+            self._add(self._counts, b0, count)
+            self._add(self._totals, b0, total)
+            self.count += count
+            self.total += total
+        else:
+            # the blocks spanned are joined around the new chunks and cut
+            # again, with a neighbour so that small blocks do not pile up
+            head_ids = self._ids[b0][:l0*sz]
+            head_sizes = self._sizes[b0][:l0]
+            tail_ids = self._ids[b1][l1*sz:]
+            tail_sizes = self._sizes[b1][l1:]
+            if b1 + 1 < len(self._sizes):
+                b1 += 1
+                tail_ids += self._ids[b1]
+                tail_sizes += self._sizes[b1]
+            elif b0 > 0:
+                b0 -= 1
+                head_ids = self._ids[b0] + head_ids
+                head_sizes = self._sizes[b0] + head_sizes
+            self._split(b0, b1 + 1, head_ids + packed + tail_ids, head_sizes + sizes + tail_sizes)
+
+if __name__ == '__main__':
+    import random, time
+    random.seed(0)
+    for block in [1, 2, 3, 8]:
+        table = ChunkTable(2, block=block)
+        ids = []
+        sizes = []
+        for iteration in range(1000):
+            start = random.randint(0, len(ids))
+            stop = random.randint(start, min(len(ids), start + random.choice([0, 1, 3, 20])))
+            count = random.choice([0, 1, 2, 5, 30])
+            new_ids = [random.randbytes(2) for x in range(count)]
+            new_sizes = [random.randint(1, 9) for x in range(count)]
+            table.replace(start, stop, new_ids, new_sizes)
+            ids[start:stop] = new_ids
+            sizes[start:stop] = new_sizes
+            assert len(table) == len(ids) and table.total == sum(sizes)
+            if iteration % 100 == 0:
+                assert table.ids() == ids and table.sizes() == sizes
+                offs = list(itertools.accumulate(sizes, initial=0))
+                for idx in range(len(ids)):
+                    assert table.offset(idx) == offs[idx]
+                    assert table.find(offs[idx] + sizes[idx] - 1) == [idx, sizes[idx] - 1]
+    # edits near the front of a million-chunk document
+    count = 1 << 20
+    ids = [idx.to_bytes(8, 'little') for idx in range(count)]
+    sizes = [4088] * count
+    start = time.perf_counter()
+    table = ChunkTable(8, b''.join(ids), sizes)
+    print(f'built {count} chunks in {time.perf_counter()-start:.2f}s')
+    start = time.perf_counter()
+    for idx in range(1000):
+        off = random.randrange(1 << 20)
+        idx, off = table.find(off)
+        table.replace(idx, idx + 1, [bytes(8), bytes(8)], [off or 1, 4088 - off or 1])
+    print(f'table: {(time.perf_counter()-start):.3f}ms per edit')
+    # edits across a block boundary, some adding blocks
+    for count in [2, 1000, 3000]:
+        start = time.perf_counter()
+        for it in range(100):
+            b = random.randrange(1, len(table._sizes) - 1)
+            idx = table._prefix(table._counts, b) - count // 2
+            table.replace(idx, idx + count // 2, [bytes(8)] * count, [2044] * count)
+        print(f'table: {(time.perf_counter()-start)*10:.3f}ms per edit of {count} chunks across blocks')
+    offs = list(itertools.accumulate(sizes, initial=0))
+    start = time.perf_counter()
+    for idx in range(10):
+        off = random.randrange(1 << 20)
+        idx = bisect_right(offs, off) - 1
+        ids[idx:idx+1] = [bytes(8), bytes(8)]
+        sizes[idx:idx+1] = [2044, 2044]
+        offs[idx:] = itertools.accumulate(sizes[idx:], initial=offs[idx])
+    print(f'lists: {(time.perf_counter()-start)*100:.3f}ms per edit')